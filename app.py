@@ -1,24 +1,105 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g, has_app_context, has_request_context, send_file, make_response
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_cors import CORS
 from datetime import datetime, timedelta
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache, wraps
+import cProfile
+import csv
+import hashlib
+import heapq
+import hmac
+import io
+import json
+import os
+import pstats
+import queue
+import random
+import re
+import secrets
+import socket
+import threading
+import time
+import uuid
+import zlib
+import click
+import numpy as np
 import config
-from werkzeug.security import generate_password_hash, check_password_hash
+import forecast
+from recipes import build_recipe_matrix
+from sqlalchemy import event, inspect
+from sqlalchemy.schema import AddConstraint, CreateColumn, DropIndex
+from sqlalchemy.orm import with_loader_criteria
+from sqlalchemy.exc import IntegrityError, OperationalError
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
 
 app = Flask(__name__)
 app.config.from_object(config)
 
+# 没有配置签名密钥时不能使用固定的默认值，否则任何人都能伪造登录令牌。
+# 开发服务器和命令行随机生成密钥；多进程的生产入口（wsgi.py、asgi.py）未设置时拒绝启动
+if not app.config.get('SECRET_KEY'):
+    app.config['SECRET_KEY'] = secrets.token_hex(32)
+    app.logger.warning('未设置SECRET_KEY环境变量，已随机生成签名密钥，重启后已签发的登录令牌全部失效')
+
 # 修改CORS配置
 CORS(app, resources={
     r"/*": {
         "origins": ["http://localhost:8080"],
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization", "Access-Control-Allow-Credentials"],
+        "allow_headers": ["Content-Type", "Authorization", "Access-Control-Allow-Credentials", "X-Profile", "X-Profile-Token", "Idempotency-Key", "X-Store-Id"],
         "supports_credentials": True
     }
 })
 
-db = SQLAlchemy(app)
+# 当前请求或后台线程所属的门店，未指定时返回None（如命令行维护任务，此时不按门店过滤）
+def current_store_id():
+    return g.get('store_id') if has_app_context() else None
+
+# 辅助函数，新数据写入的门店，未指定门店时写入默认门店
+def store_id_or_default():
+    store_id = current_store_id()
+    return app.config['DEFAULT_STORE_ID'] if store_id is None else store_id
+
+# 按门店选择数据库：配置了独立数据库（STORE_DATABASES）的门店使用各自的库，门店表等共享数据始终在默认库
+class StoreSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        store_id = current_store_id()
+        if bind is None and store_id is not None:
+            engine = self._db.engines.get(f'store_{store_id}')
+            if engine is not None and not (mapper is not None and getattr(inspect(mapper).class_, '__store_shared__', False)):
+                return engine
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': StoreSession})
+
+# 按门店划分数据的模型：查询时自动限定为当前门店，新增时自动填入当前门店
+class StoreScoped:
+    store_id = db.Column(db.Integer, nullable=False, default=store_id_or_default,
+                         server_default=str(config.DEFAULT_STORE_ID))  # 所属门店ID
+
+@event.listens_for(StoreSession, 'do_orm_execute')
+def filter_by_store(execute_state):
+    store_id = current_store_id()
+    if store_id is None or execute_state.is_insert:
+        return
+    # 按主键批量UPDATE不能附加条件，这些主键本身来自已按门店过滤的查询
+    if isinstance(execute_state.parameters, list):
+        return
+    execute_state.statement = execute_state.statement.options(with_loader_criteria(
+        StoreScoped, lambda cls: cls.store_id == store_id, include_aliases=True))
+
+# 门店模型，保存在默认库中
+class Store(db.Model):
+    __store_shared__ = True
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(100), nullable=False)  # 门店名称
+    address = db.Column(db.String(200))  # 门店地址
+    phone = db.Column(db.String(20))  # 门店电话
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 # 面包分类模型
 class Category(db.Model):
@@ -27,7 +108,7 @@ class Category(db.Model):
     breads = db.relationship('Bread', backref='category', lazy=True)
 
 # 面包模型
-class Bread(db.Model):
+class Bread(StoreScoped, db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
@@ -39,11 +120,33 @@ class Bread(db.Model):
     in_stock = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_bread_store_id_category_id', 'store_id', 'category_id'),
+    )
+
+# 客户模型，按规范化后的电话号码识别同一客户，并维护订单汇总数据
+class Customer(StoreScoped, db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    phone = db.Column(db.String(20), nullable=False)  # 规范化后的电话号码，同一门店内唯一
+    name = db.Column(db.String(100))  # 最近一次下单使用的姓名
+    order_count = db.Column(db.Integer, default=0)  # 有效订单数（不含已取消）
+    total_spend = db.Column(db.Float, default=0.0)  # 已完成订单的累计消费
+    first_order_date = db.Column(db.DateTime)  # 首次下单时间
+    last_order_date = db.Column(db.DateTime)  # 最近下单时间
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('store_id', 'phone', name='uq_customer_store_id_phone'),
+        db.Index('ix_customer_store_id_total_spend', 'store_id', 'total_spend'),
+        db.Index('ix_customer_store_id_last_order_date', 'store_id', 'last_order_date'),
+    )
 
 # 订单模型
-class Order(db.Model):
+class Order(StoreScoped, db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    order_number = db.Column(db.String(50), unique=True, nullable=False)  # TB20230005
+    order_number = db.Column(db.String(50), nullable=False)  # TB20230005，同一门店内唯一
     customer_name = db.Column(db.String(100), nullable=False)  # 客户姓名
     phone = db.Column(db.String(20))  # 联系电话
     address = db.Column(db.String(200))  # 配送地址
@@ -55,30 +158,157 @@ class Order(db.Model):
     delivery_fee = db.Column(db.Float, default=0.0)  # 配送费
     total_amount = db.Column(db.Float, nullable=False)  # 订单总金额
     notes = db.Column(db.Text)  # 订单备注
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), index=True)  # 关联客户ID
+    item_count = db.Column(db.Integer, default=0)  # 面包总件数（订单项数量之和），随订单项同步维护
+    items_subtotal = db.Column(db.Float, default=0.0)  # 订单项小计（单价×数量之和），随订单项同步维护
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # 最后修改时间，用于增量同步
     items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')  # 订单项关联
+    
+    # 订单列表筛选所用索引，查询总是限定门店，因此都以store_id开头
+    __table_args__ = (
+        db.UniqueConstraint('store_id', 'order_number', name='uq_order_store_id_order_number'),
+        db.Index('ix_order_store_id_order_date', 'store_id', 'order_date'),
+        db.Index('ix_order_store_id_status_order_date', 'store_id', 'status', 'order_date'),
+        db.Index('ix_order_store_id_payment_method_order_date', 'store_id', 'payment_method', 'order_date'),
+        db.Index('ix_order_store_id_customer_name', 'store_id', 'customer_name'),
+        db.Index('ix_order_store_id_phone', 'store_id', 'phone'),
+        db.Index('ix_order_store_id_updated_at', 'store_id', 'updated_at'),
+    )
 
 # 订单项模型
-class OrderItem(db.Model):
+class OrderItem(StoreScoped, db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)  # 关联订单ID
+    bread_id = db.Column(db.Integer, db.ForeignKey('bread.id', ondelete='SET NULL'))  # 关联面包ID，面包改名后仍可按ID统计
     name = db.Column(db.String(100), nullable=False)  # 面包名称
     bread_type = db.Column(db.String(50))  # 面包类型：sourdough, baguette, croissant等
     price = db.Column(db.Float, nullable=False)  # 单价
     quantity = db.Column(db.Integer, nullable=False)  # 数量
+    
+    __table_args__ = (
+        db.Index('ix_order_item_store_id_bread_id_order_id', 'store_id', 'bread_id', 'order_id'),
+    )
+
+# 已删除订单记录（墓碑），供增量同步告知客户端删除
+class OrderTombstone(StoreScoped, db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    order_id = db.Column(db.Integer, nullable=False, index=True)  # 被删除的订单ID
+    order_number = db.Column(db.String(50))  # 被删除的订单编号
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)  # 删除时间
+    
+    __table_args__ = (
+        db.Index('ix_order_tombstone_store_id_deleted_at', 'store_id', 'deleted_at'),
+    )
+
+# 订单事件通知表，用于多个worker之间推送订单变化
+class OrderEvent(StoreScoped, db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    order_id = db.Column(db.Integer, nullable=False)  # 关联订单ID
+    event_type = db.Column(db.String(20), nullable=False)  # 事件类型：created, updated, status, deleted, archived
+    payload = db.Column(db.JSON)  # 事件发生时的订单数据
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # 事件时间
+    
+    __table_args__ = (
+        db.Index('ix_order_event_store_id_id', 'store_id', 'id'),
+    )
+
+# 归档订单模型，结构与Order一致，保存已完成或已取消的历史订单
+class OrderArchive(StoreScoped, db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # 沿用原订单ID
+    order_number = db.Column(db.String(50), nullable=False)
+    customer_name = db.Column(db.String(100), nullable=False)
+    phone = db.Column(db.String(20))
+    address = db.Column(db.String(200))
+    order_date = db.Column(db.DateTime)
+    pickup_time = db.Column(db.DateTime)
+    payment_method = db.Column(db.String(20))
+    status = db.Column(db.String(20))
+    discount = db.Column(db.Float, default=0.0)
+    delivery_fee = db.Column(db.Float, default=0.0)
+    total_amount = db.Column(db.Float, nullable=False)
+    notes = db.Column(db.Text)
+    customer_id = db.Column(db.Integer, index=True)
+    item_count = db.Column(db.Integer, default=0)
+    items_subtotal = db.Column(db.Float, default=0.0)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)  # 归档时间
+    items = db.relationship('OrderItemArchive', backref='order', lazy=True)
+    
+    __table_args__ = (
+        db.UniqueConstraint('store_id', 'order_number', name='uq_order_archive_store_id_order_number'),
+        db.Index('ix_order_archive_store_id_order_date', 'store_id', 'order_date'),
+    )
+
+# 归档订单项模型，结构与OrderItem一致
+class OrderItemArchive(StoreScoped, db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # 沿用原订单项ID
+    order_id = db.Column(db.Integer, db.ForeignKey('order_archive.id'), nullable=False, index=True)
+    bread_id = db.Column(db.Integer)
+    name = db.Column(db.String(100), nullable=False)
+    bread_type = db.Column(db.String(50))
+    price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_order_item_archive_store_id_bread_id_order_id', 'store_id', 'bread_id', 'order_id'),
+    )
+
+# 预测模型状态，按天增量更新，多个worker共享同一份状态
+class ForecastState(db.Model):
+    id = db.Column(db.String(50), primary_key=True)  # 模型名称，按门店区分
+    state = db.Column(db.JSON, nullable=False)  # 模型参数、面包ID顺序和平滑状态
+    last_date = db.Column(db.Date)  # 已纳入模型的最后一天
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# 后台任务，状态保存在数据库中，任务进程重启后可以继续处理；任务表在默认库中，由任务进程统一领取
+class Job(StoreScoped, db.Model):
+    __store_shared__ = True
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    kind = db.Column(db.String(50), nullable=False)  # 任务类型
+    params = db.Column(db.JSON)  # 任务参数
+    status = db.Column(db.String(20), default='queued', index=True)  # 任务状态：queued, running, succeeded, failed
+    result = db.Column(db.JSON)  # 任务结果摘要
+    result_path = db.Column(db.String(300))  # 结果文件路径
+    error = db.Column(db.Text)  # 失败原因
+    attempts = db.Column(db.Integer, default=0)  # 已执行次数
+    worker = db.Column(db.String(100))  # 执行任务的进程
+    heartbeat_at = db.Column(db.DateTime)  # 执行中任务的最近心跳
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+# 幂等键记录，保存首次请求的响应，客户端重试时直接返回
+class IdempotencyKey(db.Model):
+    __store_shared__ = True
+    scope = db.Column(db.String(50), primary_key=True)  # 接口范围及门店，如orders:1、expenses:1
+    key = db.Column(db.String(100), primary_key=True)  # 客户端传入的Idempotency-Key
+    request_hash = db.Column(db.String(64), nullable=False)  # 请求体的SHA-256
+    status = db.Column(db.String(20), default='processing')  # processing, completed
+    response_status = db.Column(db.Integer)  # 响应状态码
+    response_body = db.Column(db.Text)  # 响应内容
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)  # 处理中记录的租约到期时间，超过后视为处理进程已退出
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # 过期时间
 
 # 用户模型
-class User(db.Model):
+class User(StoreScoped, db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    username = db.Column(db.String(50), unique=True, nullable=False)
+    username = db.Column(db.String(50), nullable=False)
     password = db.Column(db.String(256), nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
+    email = db.Column(db.String(120), nullable=False)
     phone = db.Column(db.String(20))
     role = db.Column(db.String(20), default='staff')
     status = db.Column(db.String(20), default='active')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # 用户名和邮箱在同一门店内唯一
+    __table_args__ = (
+        db.UniqueConstraint('store_id', 'username', name='uq_user_store_id_username'),
+        db.UniqueConstraint('store_id', 'email', name='uq_user_store_id_email'),
+    )
 
 # 财务支出模型
-class Expense(db.Model):
+class Expense(StoreScoped, db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     expense_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     category = db.Column(db.String(50), nullable=False)  # 支出类别：原料采购、人工成本、水电费用、设备维护、店铺租金、其他支出
@@ -86,148 +316,248 @@ class Expense(db.Model):
     note = db.Column(db.String(200))  # 备注
     created_by = db.Column(db.String(50))  # 创建人
     created_at = db.Column(db.DateTime, default=datetime.utcnow)  # 记录创建时间
+    
+    __table_args__ = (
+        db.Index('ix_expense_store_id_expense_date', 'store_id', 'expense_date'),
+        db.Index('ix_expense_store_id_category', 'store_id', 'category'),
+    )
 
-# 初始化数据库
-def init_db():
-    with app.app_context():
-        db.create_all()
+# 支出类别表，随支出记录的增删改维护各类别的记录数，供类别下拉框使用
+class ExpenseCategory(StoreScoped, db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(50), nullable=False)  # 类别名称
+    expense_count = db.Column(db.Integer, default=0)  # 该类别的支出记录数，为0时不再出现在下拉框中
+    
+    __table_args__ = (
+        db.UniqueConstraint('store_id', 'name', name='uq_expense_category_store_id_name'),
+    )
+
+# 根据已完成订单按月生成财务支出模拟数据
+def generate_expense_data():
+    print("正在生成财务支出模拟数据...")
+    
+    # 支出类别和对应的备注
+    expense_categories = {
+        '原料采购': ['面粉采购', '糖采购', '奶油采购', '酵母采购', '水果采购', '巧克力采购', '坚果采购', '其他原料'],
+        '人工成本': ['员工工资', '员工奖金', '员工培训', '社保缴纳', '临时工薪资', '加班补贴'],
+        '水电费用': ['水费', '电费', '燃气费', '宽带费', '暖气费'],
+        '设备维护': ['烤箱维修', '搅拌机维护', '冷柜清洗', '设备更新', '厨房设备保养', '电器维修'],
+        '店铺租金': ['店铺月租', '物业费', '保证金', '场地装修'],
+        '其他支出': ['清洁用品', '办公用品', '广告宣传', '包装材料', '餐具更新', '杂项支出']
+    }
+    
+    # 创建者列表
+    creators = ['admin', 'staff', 'manager', 'accountant']
+    
+    # 生成与订单相匹配的支出数据
+    # 按月生成支出
+    expenses = []
+    import random
+    from datetime import timedelta
+    
+    # 获取所有已完成订单，按月份分组
+    orders_by_month = {}
+    all_orders = Order.query.filter_by(status='completed').all()
+    
+    for order in all_orders:
+        order_month = order.order_date.month
+        order_year = order.order_date.year
+        month_key = f"{order_year}-{order_month}"
         
-        # 检查是否已有支出数据
-        if Expense.query.first() is None:
-            print("正在生成财务支出模拟数据...")
-            
-            # 支出类别和对应的备注
-            expense_categories = {
-                '原料采购': ['面粉采购', '糖采购', '奶油采购', '酵母采购', '水果采购', '巧克力采购', '坚果采购', '其他原料'],
-                '人工成本': ['员工工资', '员工奖金', '员工培训', '社保缴纳', '临时工薪资', '加班补贴'],
-                '水电费用': ['水费', '电费', '燃气费', '宽带费', '暖气费'],
-                '设备维护': ['烤箱维修', '搅拌机维护', '冷柜清洗', '设备更新', '厨房设备保养', '电器维修'],
-                '店铺租金': ['店铺月租', '物业费', '保证金', '场地装修'],
-                '其他支出': ['清洁用品', '办公用品', '广告宣传', '包装材料', '餐具更新', '杂项支出']
-            }
-            
-            # 创建者列表
-            creators = ['admin', 'staff', 'manager', 'accountant']
+        if month_key not in orders_by_month:
+            orders_by_month[month_key] = []
+        
+        orders_by_month[month_key].append(order)
+    
+    # 为每个月生成支出数据
+    for month_key, month_orders in orders_by_month.items():
+        year, month = map(int, month_key.split('-'))
+        
+        # 计算月份的起止时间
+        month_start = datetime(year, month, 1)
+        if month == 12:
+            month_end = datetime(year + 1, 1, 1) - timedelta(days=1)
+        else:
+            month_end = datetime(year, month + 1, 1) - timedelta(days=1)
+        
+        # 计算当月总收入
+        month_income = sum(order.total_amount for order in month_orders)
+        
+        if month_income > 0:  # 只有当月有收入时才生成支出
+            # 原料采购：约占收入的25%
+            material_expense_total = month_income * random.uniform(0.22, 0.28)
+            material_expense_count = random.randint(3, 8)  # 每月3-8次采购
+            for _ in range(material_expense_count):
+                category = '原料采购'
+                amount = material_expense_total / material_expense_count * random.uniform(0.8, 1.2)  # 添加一些随机波动
+                expense_date = month_start + timedelta(days=random.randint(0, (month_end - month_start).days))
+                note = random.choice(expense_categories[category])
+                created_by = random.choice(creators)
+                
+                expenses.append(Expense(
+                    expense_date=expense_date,
+                    category=category,
+                    amount=round(amount, 2),
+                    note=note,
+                    created_by=created_by
+                ))
             
-            # 生成与订单相匹配的支出数据
-            # 按月生成支出
-            expenses = []
-            import random
-            from datetime import timedelta
+            # 人工成本：约占收入的15%
+            labor_expense = month_income * random.uniform(0.13, 0.17)
+            expense_date = month_end - timedelta(days=random.randint(0, 5))  # 月底发工资
+            expenses.append(Expense(
+                expense_date=expense_date,
+                category='人工成本',
+                amount=round(labor_expense, 2),
+                note='员工工资',
+                created_by='admin'
+            ))
             
-            # 获取所有已完成订单，按月份分组
-            orders_by_month = {}
-            all_orders = Order.query.filter_by(status='completed').all()
+            # 水电费用：约占收入的5%
+            utility_expense = month_income * random.uniform(0.04, 0.06)
+            expense_date = month_start + timedelta(days=random.randint(10, 20))
+            expenses.append(Expense(
+                expense_date=expense_date,
+                category='水电费用',
+                amount=round(utility_expense, 2),
+                note=random.choice(expense_categories['水电费用']),
+                created_by=random.choice(creators)
+            ))
             
-            for order in all_orders:
-                order_month = order.order_date.month
-                order_year = order.order_date.year
-                month_key = f"{order_year}-{order_month}"
-                
-                if month_key not in orders_by_month:
-                    orders_by_month[month_key] = []
-                
-                orders_by_month[month_key].append(order)
+            # 设备维护：约占收入的3%
+            if random.random() > 0.3:  # 不是每个月都有设备维护
+                equipment_expense = month_income * random.uniform(0.02, 0.04)
+                expense_date = month_start + timedelta(days=random.randint(0, (month_end - month_start).days))
+                expenses.append(Expense(
+                    expense_date=expense_date,
+                    category='设备维护',
+                    amount=round(equipment_expense, 2),
+                    note=random.choice(expense_categories['设备维护']),
+                    created_by=random.choice(creators)
+                ))
             
-            # 为每个月生成支出数据
-            for month_key, month_orders in orders_by_month.items():
-                year, month = map(int, month_key.split('-'))
-                
-                # 计算月份的起止时间
-                month_start = datetime(year, month, 1)
-                if month == 12:
-                    month_end = datetime(year + 1, 1, 1) - timedelta(days=1)
-                else:
-                    month_end = datetime(year, month + 1, 1) - timedelta(days=1)
-                
-                # 计算当月总收入
-                month_income = sum(order.total_amount for order in month_orders)
-                
-                if month_income > 0:  # 只有当月有收入时才生成支出
-                    # 原料采购：约占收入的25%
-                    material_expense_total = month_income * random.uniform(0.22, 0.28)
-                    material_expense_count = random.randint(3, 8)  # 每月3-8次采购
-                    for _ in range(material_expense_count):
-                        category = '原料采购'
-                        amount = material_expense_total / material_expense_count * random.uniform(0.8, 1.2)  # 添加一些随机波动
-                        expense_date = month_start + timedelta(days=random.randint(0, (month_end - month_start).days))
-                        note = random.choice(expense_categories[category])
-                        created_by = random.choice(creators)
-                        
-                        expenses.append(Expense(
-                            expense_date=expense_date,
-                            category=category,
-                            amount=round(amount, 2),
-                            note=note,
-                            created_by=created_by
-                        ))
-                    
-                    # 人工成本：约占收入的15%
-                    labor_expense = month_income * random.uniform(0.13, 0.17)
-                    expense_date = month_end - timedelta(days=random.randint(0, 5))  # 月底发工资
-                    expenses.append(Expense(
-                        expense_date=expense_date,
-                        category='人工成本',
-                        amount=round(labor_expense, 2),
-                        note='员工工资',
-                        created_by='admin'
-                    ))
-                    
-                    # 水电费用：约占收入的5%
-                    utility_expense = month_income * random.uniform(0.04, 0.06)
-                    expense_date = month_start + timedelta(days=random.randint(10, 20))
-                    expenses.append(Expense(
-                        expense_date=expense_date,
-                        category='水电费用',
-                        amount=round(utility_expense, 2),
-                        note=random.choice(expense_categories['水电费用']),
-                        created_by=random.choice(creators)
-                    ))
-                    
-                    # 设备维护：约占收入的3%
-                    if random.random() > 0.3:  # 不是每个月都有设备维护
-                        equipment_expense = month_income * random.uniform(0.02, 0.04)
-                        expense_date = month_start + timedelta(days=random.randint(0, (month_end - month_start).days))
-                        expenses.append(Expense(
-                            expense_date=expense_date,
-                            category='设备维护',
-                            amount=round(equipment_expense, 2),
-                            note=random.choice(expense_categories['设备维护']),
-                            created_by=random.choice(creators)
-                        ))
-                    
-                    # 店铺租金：约占收入的8%
-                    rent_expense = month_income * random.uniform(0.07, 0.09)
-                    expense_date = month_start + timedelta(days=random.randint(0, 5))  # 月初交租金
-                    expenses.append(Expense(
-                        expense_date=expense_date,
-                        category='店铺租金',
-                        amount=round(rent_expense, 2),
-                        note='店铺月租',
-                        created_by='admin'
-                    ))
-                    
-                    # 其他支出：约占收入的4%
-                    other_expense_count = random.randint(1, 4)  # 每月1-4次其他支出
-                    other_expense_total = month_income * random.uniform(0.03, 0.05)
-                    for _ in range(other_expense_count):
-                        amount = other_expense_total / other_expense_count * random.uniform(0.7, 1.3)
-                        expense_date = month_start + timedelta(days=random.randint(0, (month_end - month_start).days))
-                        expenses.append(Expense(
-                            expense_date=expense_date,
-                            category='其他支出',
-                            amount=round(amount, 2),
-                            note=random.choice(expense_categories['其他支出']),
-                            created_by=random.choice(creators)
-                        ))
+            # 店铺租金：约占收入的8%
+            rent_expense = month_income * random.uniform(0.07, 0.09)
+            expense_date = month_start + timedelta(days=random.randint(0, 5))  # 月初交租金
+            expenses.append(Expense(
+                expense_date=expense_date,
+                category='店铺租金',
+                amount=round(rent_expense, 2),
+                note='店铺月租',
+                created_by='admin'
+            ))
             
-            # 添加所有支出数据
-            if expenses:
-                db.session.add_all(expenses)
-                db.session.commit()
-                print(f'创建了{len(expenses)}条财务支出记录')
+            # 其他支出：约占收入的4%
+            other_expense_count = random.randint(1, 4)  # 每月1-4次其他支出
+            other_expense_total = month_income * random.uniform(0.03, 0.05)
+            for _ in range(other_expense_count):
+                amount = other_expense_total / other_expense_count * random.uniform(0.7, 1.3)
+                expense_date = month_start + timedelta(days=random.randint(0, (month_end - month_start).days))
+                expenses.append(Expense(
+                    expense_date=expense_date,
+                    category='其他支出',
+                    amount=round(amount, 2),
+                    note=random.choice(expense_categories['其他支出']),
+                    created_by=random.choice(creators)
+                ))
+    
+    # 添加所有支出数据
+    if expenses:
+        db.session.add_all(expenses)
+        db.session.commit()
+        rebuild_expense_categories()
+        print(f'创建了{len(expenses)}条财务支出记录')
+    else:
+        print('没有找到订单数据，无法生成支出记录')
+
+# 升级表结构：create_all只会创建缺少的表，已有表中后来新增的列、索引和唯一约束在这里补上，
+# 被门店维度取代的旧索引（如全局唯一的订单编号）一并删除。返回执行过的变更说明
+def upgrade_schema(engine):
+    db.metadata.create_all(engine)
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    changes = []
+    
+    def execute(statement, description):
+        try:
+            with engine.begin() as conn:
+                conn.execute(statement)
+            changes.append(description)
+        except Exception as e:
+            changes.append(f'{description}失败：{e}')
+    
+    for table in db.metadata.sorted_tables:
+        # 新增的列按模型定义添加，带server_default的列（如store_id）已有行会取默认值
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_spec = CreateColumn(column).compile(dialect=engine.dialect)
+                execute(db.text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column_spec}'),
+                        f'{table.name}: 新增列 {column.name}')
+        
+        existing_indexes = {index['name']: index for index in inspector.get_indexes(table.name)}
+        existing_uniques = {constraint['name'] for constraint in inspector.get_unique_constraints(table.name)}
+        unique_constraints = [constraint for constraint in table.constraints
+                              if isinstance(constraint, db.UniqueConstraint) and constraint.name]
+        
+        # 删除模型中已不存在的旧索引和唯一约束；外键仍依赖的索引删除会失败，保留即可
+        known_names = {index.name for index in table.indexes} | {constraint.name for constraint in unique_constraints}
+        for name, index in existing_indexes.items():
+            if name in known_names or not (index['unique'] or name.startswith('ix_')):
+                continue
+            columns = [table.c[column_name] for column_name in index['column_names'] if column_name in table.c]
+            if len(columns) == len(index['column_names']):
+                execute(DropIndex(db.Index(name, *columns)), f'{table.name}: 删除旧索引 {name}')
+        
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                execute(db.schema.CreateIndex(index), f'{table.name}: 新增索引 {index.name}')
+        for constraint in unique_constraints:
+            if constraint.name in existing_uniques or constraint.name in existing_indexes:
+                continue
+            if engine.dialect.name == 'sqlite':
+                # SQLite不支持ALTER TABLE添加约束，用同名唯一索引代替
+                statement = db.schema.CreateIndex(db.Index(constraint.name, *constraint.columns, unique=True))
             else:
-                print('没有找到订单数据，无法生成支出记录')
+                statement = AddConstraint(constraint)
+            execute(statement, f'{table.name}: 新增唯一约束 {constraint.name}')
+    
+    return changes
+
+# 确保默认门店和配置了独立数据库的门店存在
+def ensure_stores():
+    for store_id in {app.config['DEFAULT_STORE_ID'], *app.config.get('STORE_DATABASES', {})}:
+        if db.session.get(Store, store_id) is None:
+            db.session.add(Store(id=store_id, name='总店' if store_id == app.config['DEFAULT_STORE_ID'] else f'门店{store_id}'))
+    db.session.commit()
+
+# 辅助函数，把默认库中的面包分类复制到各门店的独立数据库，门店库的面包外键引用的是本库的分类表
+def sync_store_categories():
+    categories = db.session.execute(db.select(Category.id, Category.name),
+                                    bind_arguments={'bind': db.engine}).all()
+    synced = {}
+    for bind_key, engine in db.engines.items():
+        if not (bind_key or '').startswith('store_'):
+            continue
+        with engine.begin() as connection:
+            existing = set(connection.execute(db.select(Category.__table__.c.id)).scalars())
+            missing = [{'id': category_id, 'name': name} for category_id, name in categories if category_id not in existing]
+            if missing:
+                connection.execute(Category.__table__.insert(), missing)
+        synced[bind_key] = len(missing)
+    return synced
+
+# 初始化数据库
+def init_db():
+    with app.app_context():
+        # 默认库和使用独立数据库的门店都建表，已有的表补齐新增的列
+        for engine in db.engines.values():
+            upgrade_schema(engine)
+        ensure_stores()
+        
+        # 检查是否已有支出数据
+        if Expense.query.first() is None:
+            generate_expense_data()
         
         # 检查是否已有分类数据
         if Category.query.first() is None:
@@ -375,6 +705,7 @@ def init_db():
                     
                     item = OrderItem(
                         order_id=order.id,
+                        bread_id=bread.id,
                         name=bread.name,
                         bread_type=bread.category_id,
                         price=item_price,
@@ -384,16 +715,24 @@ def init_db():
                 
                 # 计算订单总金额（减去折扣，加上配送费）
                 order.total_amount = round(total_amount - order.discount + order.delivery_fee, 2)
+                order.item_count = sum(item.quantity for item in order_items[-num_items:])
+                order.items_subtotal = round(total_amount, 2)
             
             # 提交订单项
             db.session.add_all(order_items)
             db.session.commit()
             
+            # 为示例订单建立客户并计算汇总
+            backfill_customers()
+        
+        # 使用独立数据库的门店同样需要分类数据才能新增面包
+        sync_store_categories()
+            
         # 添加默认用户
         if User.query.filter_by(username='admin').first() is None:
             admin_user = User(
                 username='admin',
-                password=generate_password_hash('admin123'),
+                password=generate_password_hash('admin123', app.config['PASSWORD_HASH_METHOD']),
                 email='admin@example.com',
                 phone='13888888888',
                 role='admin',
@@ -401,7 +740,7 @@ def init_db():
             )
             staff_user = User(
                 username='staff',
-                password=generate_password_hash('staff123'),
+                password=generate_password_hash('staff123', app.config['PASSWORD_HASH_METHOD']),
                 email='staff@example.com',
                 phone='13777777777',
                 role='staff',
@@ -411,6 +750,328 @@ def init_db():
             db.session.commit()
             print('创建了默认用户：admin/admin123 和 staff/staff123')
 
+# 辅助函数，依次在每个门店下执行维护任务（命令行没有请求中的门店），返回 {门店ID: 结果}
+def for_each_store(func, *args, **kwargs):
+    results = {}
+    for (store_id,) in db.session.query(Store.id).order_by(Store.id).all():
+        g.store_id = store_id
+        try:
+            results[store_id] = func(*args, **kwargs)
+        finally:
+            g.pop('store_id', None)
+    return results
+
+# 归档任务：把超过保留期的已完成、已取消订单分批搬到归档表，保持热表和索引足够小
+def archive_orders(older_than_days=None, batch_size=None):
+    older_than_days = older_than_days or app.config.get('ORDER_ARCHIVE_AFTER_DAYS', 365)
+    batch_size = batch_size or app.config.get('ORDER_ARCHIVE_BATCH_SIZE', 500)
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    
+    # 按归档表的列从热表复制，两张表的列需保持一致
+    order_columns = [c.name for c in OrderArchive.__table__.columns if c.name in Order.__table__.columns]
+    item_columns = [c.name for c in OrderItemArchive.__table__.columns if c.name in OrderItem.__table__.columns]
+    
+    archived = 0
+    while True:
+        orders = db.session.query(Order.id, Order.order_number).filter(
+            Order.status.in_(('completed', 'cancelled')),
+            Order.order_date < cutoff
+        ).order_by(Order.id).limit(batch_size).all()
+        if not orders:
+            break
+        order_ids = [order.id for order in orders]
+        
+        # 每批在一个事务内完成复制和删除
+        db.session.execute(db.insert(OrderArchive).from_select(
+            order_columns,
+            db.select(*[Order.__table__.c[name] for name in order_columns]).where(Order.id.in_(order_ids))
+        ))
+        db.session.execute(db.insert(OrderItemArchive).from_select(
+            item_columns,
+            db.select(*[OrderItem.__table__.c[name] for name in item_columns]).where(OrderItem.order_id.in_(order_ids))
+        ))
+        OrderItem.query.filter(OrderItem.order_id.in_(order_ids)).delete(synchronize_session=False)
+        Order.query.filter(Order.id.in_(order_ids)).delete(synchronize_session=False)
+        
+        # 订单离开热表后，增量同步的客户端通过墓碑、SSE订阅者通过archived事件把它移除
+        db.session.execute(db.insert(OrderTombstone), [
+            {'order_id': order.id, 'order_number': order.order_number} for order in orders
+        ])
+        db.session.execute(db.insert(OrderEvent), [
+            {'order_id': order.id, 'event_type': 'archived',
+             'payload': {'id': order.id, 'orderNumber': order.order_number}} for order in orders
+        ])
+        db.session.commit()
+        archived += len(order_ids)
+    
+    return archived
+
+@app.cli.command('archive-orders')
+@click.option('--days', type=int, default=None, help='归档多少天以前的订单，默认读取ORDER_ARCHIVE_AFTER_DAYS')
+@click.option('--batch-size', type=int, default=None, help='每批归档的订单数')
+def archive_orders_command(days, batch_size):
+    """把历史订单移入归档表"""
+    count = sum(for_each_store(archive_orders, days, batch_size).values())
+    print(f'归档了{count}条订单')
+
+# 回填订单汇总字段：按ID分段，用关联子查询从订单项重新计算件数和小计
+def backfill_order_summary(order_model, item_model, batch_size=5000):
+    max_id = db.session.query(db.func.max(order_model.id)).scalar() or 0
+    item_count = db.select(db.func.coalesce(db.func.sum(item_model.quantity), 0)) \
+        .where(item_model.order_id == order_model.id).scalar_subquery()
+    items_subtotal = db.select(db.func.coalesce(db.func.sum(item_model.price * item_model.quantity), 0)) \
+        .where(item_model.order_id == order_model.id).scalar_subquery()
+    
+    for start_id in range(0, max_id + 1, batch_size):
+        db.session.execute(db.update(order_model).where(
+            order_model.id > start_id,
+            order_model.id <= start_id + batch_size
+        ).values(item_count=item_count, items_subtotal=db.func.round(items_subtotal, 2)))
+        db.session.commit()
+
+@app.cli.command('backfill-order-summary')
+def backfill_order_summary_command():
+    """回填订单及归档订单的件数和小计字段"""
+    for_each_store(backfill_order_summary, Order, OrderItem)
+    for_each_store(backfill_order_summary, OrderArchive, OrderItemArchive)
+    print('订单汇总字段回填完成')
+
+# 回填订单项的面包ID：按名称匹配现有面包
+def backfill_order_item_bread(item_model):
+    bread_id = db.select(db.func.min(Bread.id)).where(Bread.name == item_model.name).scalar_subquery()
+    result = db.session.execute(db.update(item_model).where(item_model.bread_id.is_(None)).values(bread_id=bread_id))
+    db.session.commit()
+    return result.rowcount
+
+@app.cli.command('backfill-order-item-bread')
+def backfill_order_item_bread_command():
+    """按面包名称回填订单项及归档订单项的面包ID"""
+    count = sum(for_each_store(backfill_order_item_bread, OrderItem).values()) + \
+        sum(for_each_store(backfill_order_item_bread, OrderItemArchive).values())
+    print(f'处理了{count}条订单项')
+
+# 回填客户：按ID分批为未关联客户的订单建立客户，再分批重新计算客户汇总
+def backfill_customers(batch_size=1000):
+    for order_model in (Order, OrderArchive):
+        last_id = 0
+        while True:
+            orders = db.session.query(order_model.id, order_model.phone, order_model.customer_name).filter(
+                order_model.id > last_id,
+                order_model.customer_id.is_(None)
+            ).order_by(order_model.id).limit(batch_size).all()
+            if not orders:
+                break
+            last_id = orders[-1].id
+            
+            phones = {order.id: normalize_phone(order.phone) for order in orders}
+            customers = {customer.phone: customer for customer in
+                         Customer.query.filter(Customer.phone.in_(set(phones.values()) - {None}))}
+            for order in orders:
+                phone = phones[order.id]
+                if phone and phone not in customers:
+                    customers[phone] = Customer(phone=phone, name=order.customer_name)
+                    db.session.add(customers[phone])
+            db.session.flush()
+            
+            links = [{'id': order_id, 'customer_id': customers[phone].id}
+                     for order_id, phone in phones.items() if phone]
+            if links:
+                db.session.execute(db.update(order_model), links)
+            db.session.commit()
+    
+    last_id = 0
+    while True:
+        customer_ids = [customer_id for (customer_id,) in db.session.query(Customer.id).filter(
+            Customer.id > last_id
+        ).order_by(Customer.id).limit(batch_size)]
+        if not customer_ids:
+            break
+        last_id = customer_ids[-1]
+        refresh_customer_stats(customer_ids)
+        db.session.commit()
+
+@app.cli.command('backfill-customers')
+def backfill_customers_command():
+    """为历史订单建立客户关联并计算客户汇总"""
+    for_each_store(backfill_customers)
+    print(f'客户回填完成，共{Customer.query.count()}位客户')
+
+# 辅助函数，判断查询的起始日期是否落在已归档的数据范围内
+def range_reaches_archive(start_date):
+    latest_archived = db.session.query(db.func.max(OrderArchive.order_date)).scalar()
+    if latest_archived is None:
+        return False
+    return start_date is None or start_date <= latest_archived
+
+# 辅助函数，查询日期范围内的已完成订单，范围覆盖归档数据时一并查询归档表
+def completed_orders_between(start_date, end_date):
+    orders = Order.query.filter(
+        Order.order_date >= start_date,
+        Order.order_date <= end_date,
+        Order.status == 'completed'
+    ).all()
+    if range_reaches_archive(start_date):
+        orders += OrderArchive.query.filter(
+            OrderArchive.order_date >= start_date,
+            OrderArchive.order_date <= end_date,
+            OrderArchive.status == 'completed'
+        ).all()
+    return orders
+
+# 已知门店ID缓存，遇到未知ID时重新查询一次门店表
+_known_store_ids = set()
+
+def store_exists(store_id):
+    if store_id not in _known_store_ids:
+        _known_store_ids.update(store_id for (store_id,) in db.session.query(Store.id).all())
+    return store_id in _known_store_ids
+
+# 确定请求所属门店：优先读取X-Store-Id请求头，其次是store参数，都没有时使用默认门店
+@app.before_request
+def resolve_store():
+    value = request.headers.get('X-Store-Id') or request.args.get('store')
+    if not value:
+        g.store_id = app.config['DEFAULT_STORE_ID']
+        return None
+    try:
+        store_id = int(value)
+    except ValueError:
+        return jsonify({'error': '门店ID无效'}), 400
+    if not store_exists(store_id):
+        return jsonify({'error': '门店不存在'}), 404
+    g.store_id = store_id
+    return None
+
+def store_to_dict(store):
+    return {
+        'id': store.id,
+        'name': store.name,
+        'address': store.address,
+        'phone': store.phone,
+        'hasOwnDatabase': f'store_{store.id}' in db.engines,
+        'createdAt': store.created_at.isoformat() if store.created_at else None
+    }
+
+@app.route('/api/stores', methods=['GET'])
+def get_stores():
+    stores = Store.query.order_by(Store.id).all()
+    return jsonify([store_to_dict(store) for store in stores])
+
+@app.route('/api/stores', methods=['POST'])
+def create_store():
+    data = request.json
+    store = Store(name=data['name'], address=data.get('address'), phone=data.get('phone'))
+    db.session.add(store)
+    db.session.commit()
+    return jsonify({'message': '门店创建成功', 'id': store.id}), 201
+
+# 幂等请求：带Idempotency-Key的请求只执行一次，重试时返回首次的响应，并发的重复请求等待首个请求完成
+def idempotent(scope):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > 100:
+                return jsonify({'error': 'Idempotency-Key过长'}), 400
+            
+            # 不同门店可以使用相同的键
+            store_scope = f'{scope}:{store_id_or_default()}'
+            request_hash = hashlib.sha256(request.get_data()).hexdigest()
+            if not claim_idempotency_key(store_scope, key, request_hash):
+                return replay_idempotent_response(store_scope, key, request_hash)
+            
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                db.session.rollback()
+                release_idempotency_key(store_scope, key)
+                raise
+            
+            # 服务端错误不保存，允许客户端用同一个键重试
+            if response.status_code >= 500:
+                release_idempotency_key(store_scope, key)
+            else:
+                record = db.session.get(IdempotencyKey, (store_scope, key))
+                if record is not None:
+                    record.status = 'completed'
+                    record.locked_until = None
+                    record.response_status = response.status_code
+                    record.response_body = response.get_data(as_text=True)
+                    db.session.commit()
+            return response
+        return wrapper
+    return decorator
+
+def claim_idempotency_key(scope, key, request_hash):
+    """写入处理中的幂等键记录，主键冲突说明已有相同的请求"""
+    now = datetime.utcnow()
+    ttl = timedelta(hours=app.config.get('IDEMPOTENCY_TTL_HOURS', 24))
+    lease = timedelta(seconds=app.config.get('IDEMPOTENCY_LEASE_SECONDS', 120))
+    
+    # 顺带清理少量过期记录
+    if random.random() < 0.01:
+        IdempotencyKey.query.filter(IdempotencyKey.expires_at < now).delete(synchronize_session=False)
+        db.session.commit()
+    
+    # 先不加锁地读取：已有记录时才按主键删除，避免InnoDB对不存在的键加间隙锁，并发的重复请求在INSERT时互相死锁
+    record = db.session.get(IdempotencyKey, (scope, key))
+    if record is not None:
+        # 已过期的同名键可以重新使用；处理中但租约已到期的记录说明处理进程被杀死，允许接管
+        reusable = record.expires_at < now or (record.status == 'processing' and record.locked_until and record.locked_until < now)
+        if not reusable:
+            db.session.rollback()
+            return False
+        IdempotencyKey.query.filter_by(scope=scope, key=key).filter(db.or_(
+            IdempotencyKey.expires_at < now,
+            db.and_(IdempotencyKey.status == 'processing', IdempotencyKey.locked_until < now)
+        )).delete(synchronize_session=False)
+        db.session.expunge(record)
+    
+    db.session.add(IdempotencyKey(scope=scope, key=key, request_hash=request_hash, created_at=now,
+                                  locked_until=now + lease, expires_at=now + ttl))
+    try:
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    except OperationalError as e:
+        # 同时接管同一个键时仍可能死锁或等锁超时，按重复请求处理
+        db.session.rollback()
+        if not is_lock_conflict(e):
+            raise
+        return False
+
+# 辅助函数，判断数据库错误是否为死锁或等锁超时（MySQL 1213、1205），这类错误重试或按冲突处理即可
+def is_lock_conflict(error):
+    args = getattr(error.orig, 'args', ())
+    return bool(args) and args[0] in (1205, 1213)
+
+def release_idempotency_key(scope, key):
+    IdempotencyKey.query.filter_by(scope=scope, key=key).delete(synchronize_session=False)
+    db.session.commit()
+
+def replay_idempotent_response(scope, key, request_hash):
+    deadline = time.time() + app.config.get('IDEMPOTENCY_WAIT_SECONDS', 10)
+    while True:
+        record = IdempotencyKey.query.filter_by(scope=scope, key=key).first()
+        if record is None:
+            # 首个请求失败后已释放该键
+            return jsonify({'error': '相同Idempotency-Key的请求处理失败，请重试'}), 409
+        if record.request_hash != request_hash:
+            return jsonify({'error': 'Idempotency-Key已用于不同的请求'}), 422
+        if record.status == 'completed':
+            response = Response(record.response_body, status=record.response_status, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        if time.time() >= deadline:
+            return jsonify({'error': '相同Idempotency-Key的请求正在处理中'}), 409
+        # 结束当前事务，下一次查询才能看到首个请求提交的结果
+        db.session.rollback()
+        time.sleep(0.05)
+
 # 面包分类路由
 @app.route('/api/categories', methods=['GET'])
 def get_categories():
@@ -500,6 +1161,206 @@ def update_bread(bread_id):
         db.session.rollback()
         return jsonify({'message': '更新失败', 'error': str(e)}), 400
 
+# 热销榜的单个时间窗口：按固定粒度分桶计数，并维护窗口内的累计值
+class SalesWindow:
+    def __init__(self, span, granularity):
+        self.span = span
+        self.granularity = granularity
+        self.buckets = {}  # 桶起始时间 -> Counter(面包ID -> 数量)
+        self.totals = Counter()
+
+    def add(self, timestamp, bread_id, quantity):
+        epoch = datetime(1970, 1, 1)
+        bucket = epoch + (timestamp - epoch) // self.granularity * self.granularity
+        self.buckets.setdefault(bucket, Counter())[bread_id] += quantity
+        self.totals[bread_id] += quantity
+
+    def expire(self, now):
+        cutoff = now - self.span
+        expired = [bucket for bucket in self.buckets if bucket + self.granularity <= cutoff]
+        for bucket in expired:
+            self.totals.subtract(self.buckets.pop(bucket))
+        if expired:
+            self.totals = +self.totals  # 去掉减为0的项
+
+# 进程内热销榜：下单提交后更新计数，worker启动后首次访问时从数据库重建，之后定期后台重建以合并其他worker的订单
+class BestSellerBoard:
+    WINDOWS = {
+        '1h': (timedelta(hours=1), timedelta(minutes=1)),
+        '24h': (timedelta(hours=24), timedelta(hours=1)),
+        '7d': (timedelta(days=7), timedelta(hours=1))
+    }
+
+    def __init__(self, store_id):
+        self.store_id = store_id
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()  # 同一时间只允许一次重建，暂存区由正在进行的重建独占
+        self._windows = None
+        self._names = {}
+        self._built_at = 0
+        self._rebuilding = False
+        self._pending = None  # 重建期间记录的订单 [(订单ID, 下单时间, 订单项)]，换入新窗口前合并
+
+    def _new_windows(self):
+        return {key: SalesWindow(span, granularity) for key, (span, granularity) in self.WINDOWS.items()}
+
+    def rebuild(self):
+        with self._rebuild_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        # 查询前开始暂存新订单，查询期间提交的订单不会漏掉
+        with self._lock:
+            self._pending = []
+        try:
+            now = datetime.utcnow()
+            rows = db.session.query(Order.id, Order.order_date, OrderItem.bread_id, OrderItem.name, OrderItem.quantity) \
+                .join(Order, Order.id == OrderItem.order_id).filter(
+                    OrderItem.bread_id.isnot(None),
+                    Order.order_date >= now - self.WINDOWS['7d'][0],
+                    Order.status != 'cancelled'
+                ).all()
+            windows = self._new_windows()
+            names = {}
+            loaded_ids = set()
+            for order_id, order_date, bread_id, name, quantity in rows:
+                loaded_ids.add(order_id)
+                names[bread_id] = name
+                for window in windows.values():
+                    window.add(order_date, bread_id, quantity)
+            with self._lock:
+                # 合并重建期间记录的订单，查询结果中已包含的跳过，避免重复计数
+                for order_id, order_date, items in self._pending:
+                    if order_id in loaded_ids:
+                        continue
+                    self._add(windows, names, order_date, items)
+                self._windows = windows
+                self._names = names
+                self._built_at = time.time()
+        finally:
+            with self._lock:
+                self._pending = None
+
+    @staticmethod
+    def _add(windows, names, order_date, items):
+        for bread_id, name, quantity in items:
+            if bread_id is None:
+                continue
+            names[bread_id] = name
+            for window in windows.values():
+                window.add(order_date, bread_id, quantity)
+
+    def _background_rebuild(self):
+        with app.app_context():
+            g.store_id = self.store_id
+            try:
+                self.rebuild()
+            except Exception as e:
+                print(f"热销榜重建失败: {e}")
+            finally:
+                self._rebuilding = False
+                db.session.remove()
+
+    def record(self, order_id, order_date, items):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((order_id, order_date, items))
+            if self._windows is None:
+                return  # 尚未构建，首次访问时会从数据库完整加载
+            self._add(self._windows, self._names, order_date, items)
+
+    def top(self, window_key, limit):
+        if self._windows is None:
+            self.rebuild()
+        elif time.time() - self._built_at > app.config.get('BEST_SELLER_REBUILD_SECONDS', 300) and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._background_rebuild, name='best-seller-rebuild', daemon=True).start()
+        
+        with self._lock:
+            window = self._windows[window_key]
+            window.expire(datetime.utcnow())
+            top_items = heapq.nlargest(limit, window.totals.items(), key=lambda item: item[1])
+            return [{'breadId': bread_id, 'name': self._names.get(bread_id), 'quantity': quantity}
+                    for bread_id, quantity in top_items]
+
+# 每个门店一个热销榜
+best_seller_boards = {}
+
+def best_seller_board_for(store_id):
+    board = best_seller_boards.get(store_id)
+    if board is None:
+        board = best_seller_boards.setdefault(store_id, BestSellerBoard(store_id))
+    return board
+
+# 在后台线程中预先加载各门店的热销榜，避免进程启动后的第一个请求同步查询7天的订单
+def warm_best_seller_boards():
+    def warm():
+        with app.app_context():
+            try:
+                for_each_store(lambda: best_seller_board_for(g.store_id).rebuild())
+            except Exception as e:
+                print(f"热销榜预热失败: {e}")
+            finally:
+                db.session.remove()
+    threading.Thread(target=warm, name='best-seller-warmup', daemon=True).start()
+
+@app.route('/api/breads/top', methods=['GET'])
+def get_top_breads():
+    """热销榜，数据来自进程内计数"""
+    window_key = request.args.get('window', '24h')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    if window_key not in BestSellerBoard.WINDOWS:
+        return jsonify({'error': '时间窗口无效'}), 400
+    return jsonify(best_seller_board_for(g.store_id).top(window_key, limit))
+
+@app.route('/api/breads/sales', methods=['GET'])
+def get_bread_sales():
+    """按面包ID统计已完成订单的销量和销售额"""
+    start_date_str = request.args.get('startDate', '')
+    end_date_str = request.args.get('endDate', '')
+    
+    try:
+        start_date = datetime.fromisoformat(start_date_str) if start_date_str else datetime(datetime.now().year, 1, 1)
+        end_date = datetime.fromisoformat(end_date_str) if end_date_str else datetime.now()
+    except ValueError:
+        return jsonify({'error': '日期格式无效'}), 400
+    
+    tables = [(Order, OrderItem)]
+    if range_reaches_archive(start_date):
+        tables.append((OrderArchive, OrderItemArchive))
+    
+    sales = {}
+    for order_model, item_model in tables:
+        rows = db.session.query(
+            item_model.bread_id,
+            db.func.sum(item_model.quantity),
+            db.func.sum(item_model.price * item_model.quantity),
+            db.func.count(db.distinct(item_model.order_id))
+        ).join(order_model, order_model.id == item_model.order_id).filter(
+            item_model.bread_id.isnot(None),
+            order_model.order_date >= start_date,
+            order_model.order_date <= end_date,
+            order_model.status == 'completed'
+        ).group_by(item_model.bread_id).all()
+        
+        for bread_id, quantity, amount, order_count in rows:
+            total = sales.setdefault(bread_id, [0, 0, 0])
+            total[0] += quantity or 0
+            total[1] += amount or 0
+            total[2] += order_count
+    
+    names = dict(db.session.query(Bread.id, Bread.name).filter(Bread.id.in_(sales.keys())).all()) if sales else {}
+    result = [{
+        'breadId': bread_id,
+        'name': names.get(bread_id),
+        'quantity': quantity,
+        'amount': round(amount, 2),
+        'orderCount': order_count
+    } for bread_id, (quantity, amount, order_count) in sales.items()]
+    result.sort(key=lambda x: x['amount'], reverse=True)
+    
+    return jsonify(result)
+
 # 添加专门的库存更新端点
 @app.route('/api/breads/<int:bread_id>/stock', methods=['PUT'])
 def update_bread_stock(bread_id):
@@ -525,12 +1386,11 @@ def delete_bread(bread_id):
     db.session.commit()
     return jsonify({'message': '面包删除成功'})
 
-# 订单路由
-@app.route('/api/orders', methods=['GET'])
-def get_orders():
-    orders = Order.query.all()
-    return jsonify([{
+# 辅助函数，将订单转换为接口返回格式，include_items为False时只返回汇总字段，不加载订单项
+def order_to_dict(order, include_items=True):
+    result = {
         'id': order.id,
+        'storeId': order.store_id,
         'orderNumber': order.order_number,
         'customerName': order.customer_name,
         'phone': order.phone,
@@ -543,62 +1403,571 @@ def get_orders():
         'deliveryFee': order.delivery_fee,
         'totalAmount': order.total_amount,
         'notes': order.notes,
-        'items': [{
+        'customerId': order.customer_id,
+        'itemCount': order.item_count,
+        'itemsSubtotal': order.items_subtotal,
+        'updatedAt': order.updated_at.isoformat() if order.updated_at else None
+    }
+    if include_items:
+        result['items'] = [{
             'id': item.id,
+            'breadId': item.bread_id,
             'name': item.name,
             'breadType': item.bread_type,
             'price': item.price,
             'quantity': item.quantity
         } for item in order.items]
-    } for order in orders])
+    return result
 
-@app.route('/api/orders', methods=['POST'])
-def create_order():
-    data = request.json
+# 订单事件订阅者，队列写满说明客户端消费过慢，断开后由客户端带Last-Event-ID重连补发
+class OrderEventSubscriber:
+    def __init__(self, maxsize=1000):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+# 进程内订单事件分发中心：每个worker每个门店只有一个线程轮询事件表，再分发给本进程该门店的所有SSE连接
+class OrderEventHub:
+    def __init__(self, store_id):
+        self.store_id = store_id
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = None
+        # 事件ID在插入时分配，提交顺序却可能不同：较小的ID可能在更大的ID发布之后才提交。
+        # 游标跳过的ID记为空缺 {事件ID: 发现时间}，之后每次轮询一并查询，超过回看时间仍未出现的视为已回滚
+        self._gaps = {}
+
+    def subscribe(self):
+        subscriber = OrderEventSubscriber()
+        with self._lock:
+            self._subscribers.add(subscriber)
+            # 首次订阅时才启动轮询线程，避免gunicorn预加载时在主进程中创建线程
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=f'order-event-hub-{self.store_id}', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                subscriber.overflowed = True
+
+    def poll(self):
+        now = time.time()
+        lookback = app.config.get('ORDER_EVENT_LOOKBACK_SECONDS', 60)
+        self._gaps = {event_id: found_at for event_id, found_at in self._gaps.items() if now - found_at < lookback}
+        
+        condition = OrderEvent.id > self._last_id
+        if self._gaps:
+            condition = db.or_(condition, OrderEvent.id.in_(list(self._gaps)))
+        events = OrderEvent.query.filter(condition).order_by(OrderEvent.id).limit(500).all()
+        for event in events:
+            if event.id > self._last_id:
+                # 最多记录1000个空缺，ID跳跃过大时（如自增步长变化）不再追踪
+                for missing_id in range(max(self._last_id + 1, event.id - 1000), event.id):
+                    self._gaps[missing_id] = now
+                self._last_id = event.id
+            elif self._gaps.pop(event.id, None) is None:
+                continue
+            self.publish(order_event_to_dict(event))
+
+    def _run(self):
+        poll_interval = app.config.get('ORDER_EVENT_POLL_INTERVAL', 1.0)
+        retention = timedelta(hours=app.config.get('ORDER_EVENT_RETENTION_HOURS', 24))
+        last_prune = 0
+        with app.app_context():
+            g.store_id = self.store_id
+            if self._last_id is None:
+                self._last_id = db.session.query(db.func.max(OrderEvent.id)).scalar() or 0
+            while True:
+                try:
+                    self.poll()
+
+                    # 定期清理过期事件
+                    if time.time() - last_prune > 3600:
+                        OrderEvent.query.filter(OrderEvent.created_at < datetime.utcnow() - retention).delete()
+                        db.session.commit()
+                        last_prune = time.time()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"订单事件轮询失败: {e}")
+                finally:
+                    db.session.remove()
+                time.sleep(poll_interval)
+
+order_event_hubs = {}
+
+def order_event_hub_for(store_id):
+    hub = order_event_hubs.get(store_id)
+    if hub is None:
+        hub = order_event_hubs.setdefault(store_id, OrderEventHub(store_id))
+    return hub
+
+# 辅助函数，在当前事务中记录订单事件，随业务数据一起提交
+def record_order_event(order, event_type):
+    if event_type == 'deleted':
+        payload = {'id': order.id, 'orderNumber': order.order_number}
+    else:
+        db.session.flush()  # 确保新订单和订单项已分配ID
+        payload = order_to_dict(order)
+    db.session.add(OrderEvent(order_id=order.id, event_type=event_type, payload=payload))
+
+# 辅助函数，为订单项解析面包ID：优先使用客户端传入的breadId，否则一次查询按名称匹配
+def resolve_bread_ids(items_data):
+    # 客户端传入的面包ID必须是当前门店的面包，一次查询校验，存在未知ID时抛出ValueError
+    client_ids = {item_data['breadId'] for item_data in items_data if item_data.get('breadId')}
+    if client_ids:
+        known_ids = {bread_id for (bread_id,) in db.session.query(Bread.id).filter(Bread.id.in_(client_ids))}
+        unknown_ids = client_ids - known_ids
+        if unknown_ids:
+            raise ValueError(f"面包不存在：{', '.join(str(bread_id) for bread_id in sorted(unknown_ids, key=str))}")
+    
+    # 按名称匹配时同名面包取最小ID，与回填订单项面包ID的规则一致
+    names = {item_data['name'] for item_data in items_data if not item_data.get('breadId')}
+    bread_ids = {}
+    if names:
+        bread_ids = dict(db.session.query(Bread.name, db.func.min(Bread.id))
+                         .filter(Bread.name.in_(names)).group_by(Bread.name).all())
+    return [item_data.get('breadId') or bread_ids.get(item_data['name']) for item_data in items_data]
+
+# 辅助函数，计算订单总金额（订单项小计减去折扣，加上配送费）
+def calc_order_total(subtotal, discount, delivery_fee):
+    return round(subtotal - (discount or 0) + (delivery_fee or 0), 2)
+
+# 辅助函数，规范化电话号码：只保留数字并去掉86国家码，无法识别时返回None
+def normalize_phone(phone):
+    digits = ''.join(ch for ch in (phone or '') if ch.isdigit())
+    if len(digits) == 13 and digits.startswith('86'):
+        digits = digits[2:]
+    return digits or None
+
+# 辅助函数，按电话号码查找客户，不存在时创建；并发创建同一客户时以先提交的为准
+def get_or_create_customer(phone, name):
+    customer = Customer.query.filter_by(phone=phone).first()
+    if customer is None:
+        try:
+            with db.session.begin_nested():
+                customer = Customer(phone=phone, name=name)
+                db.session.add(customer)
+        except IntegrityError:
+            customer = Customer.query.filter_by(phone=phone).first()
+    elif name and customer.name != name:
+        customer.name = name
+    return customer
+
+# 辅助函数，根据订单电话关联客户
+def link_customer(order):
+    phone = normalize_phone(order.phone)
+    order.customer_id = get_or_create_customer(phone, order.customer_name).id if phone else None
+
+# 辅助函数，重新计算指定客户的订单汇总，同时统计热表和归档表
+def refresh_customer_stats(customer_ids):
+    customer_ids = {customer_id for customer_id in customer_ids if customer_id}
+    if not customer_ids:
+        return
+    
+    # 先按ID顺序锁住客户行，并发修改同一客户订单的请求依次重算，避免后提交的旧统计覆盖新统计
+    db.session.query(Customer.id).filter(Customer.id.in_(customer_ids)) \
+        .order_by(Customer.id).with_for_update().all()
+    
+    stats = {customer_id: {'id': customer_id, 'order_count': 0, 'total_spend': 0.0,
+                           'first_order_date': None, 'last_order_date': None}
+             for customer_id in customer_ids}
+    for order_model in (Order, OrderArchive):
+        active = order_model.status != 'cancelled'
+        rows = db.session.query(
+            order_model.customer_id,
+            db.func.count(db.case((active, order_model.id))),
+            db.func.sum(db.case((order_model.status == 'completed', order_model.total_amount), else_=0)),
+            db.func.min(db.case((active, order_model.order_date))),
+            db.func.max(db.case((active, order_model.order_date)))
+        ).filter(order_model.customer_id.in_(customer_ids)).group_by(order_model.customer_id).all()
+        
+        for customer_id, order_count, total_spend, first_date, last_date in rows:
+            stat = stats[customer_id]
+            stat['order_count'] += order_count
+            stat['total_spend'] = round(stat['total_spend'] + (total_spend or 0), 2)
+            if first_date and (stat['first_order_date'] is None or first_date < stat['first_order_date']):
+                stat['first_order_date'] = first_date
+            if last_date and (stat['last_order_date'] is None or last_date > stat['last_order_date']):
+                stat['last_order_date'] = last_date
+    
+    db.session.execute(db.update(Customer), list(stats.values()))
+
+def order_event_to_dict(event):
+    return {
+        'id': event.id,
+        'type': event.event_type,
+        'orderId': event.order_id,
+        'data': event.payload
+    }
+
+def format_sse(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+# 订单路由
+@app.route('/api/orders', methods=['GET'])
+def get_orders():
+    status = request.args.get('status', '')
+    start_date_str = request.args.get('startDate', '')
+    end_date_str = request.args.get('endDate', '')
+    payment_method = request.args.get('paymentMethod', '')
+    customer_name = request.args.get('customerName', '')
+    phone = request.args.get('phone', '')
+    order_number = request.args.get('orderNumber', '')
+    include_items = request.args.get('includeItems', 'true').lower() != 'false'
+    
+    query = Order.query
+    
+    # 按状态筛选，支持逗号分隔的多个状态
+    if status:
+        query = query.filter(Order.status.in_(status.split(',')))
+    
+    # 按下单日期筛选
+    try:
+        if start_date_str:
+            query = query.filter(Order.order_date >= datetime.fromisoformat(start_date_str))
+        if end_date_str:
+            query = query.filter(Order.order_date <= datetime.fromisoformat(end_date_str))
+    except ValueError:
+        return jsonify({'error': '日期格式无效'}), 400
+    
+    if payment_method:
+        query = query.filter(Order.payment_method == payment_method)
+    # 姓名、电话和订单编号使用前缀匹配，可以走索引
+    if customer_name:
+        query = query.filter(Order.customer_name.startswith(customer_name, autoescape=True))
+    if phone:
+        query = query.filter(Order.phone.startswith(phone, autoescape=True))
+    if order_number:
+        query = query.filter(Order.order_number.startswith(order_number, autoescape=True))
+    
+    query = query.order_by(Order.order_date.desc(), Order.id.desc())
+    if include_items:
+        query = query.options(db.selectinload(Order.items))
     
-    # 生成订单编号，确保唯一性
+    # 未传分页参数时保持原有返回格式
+    if 'page' not in request.args and 'pageSize' not in request.args:
+        return jsonify([order_to_dict(order, include_items) for order in query.all()])
+    
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = min(max(request.args.get('pageSize', 20, type=int), 1), 200)
+    
+    # 总数只在筛选条件上计数，不加载订单项
+    total = query.order_by(None).with_entities(db.func.count(Order.id)).scalar()
+    orders = query.offset((page - 1) * page_size).limit(page_size).all()
+    
+    return jsonify({
+        'items': [order_to_dict(order, include_items) for order in orders],
+        'total': total,
+        'page': page,
+        'pageSize': page_size
+    })
+
+@app.route('/api/orders/changes', methods=['GET'])
+def get_order_changes():
+    """增量同步：返回游标之后新增、修改或删除的订单"""
+    since_str = request.args.get('since', '')
+    try:
+        since = datetime.fromisoformat(since_str) if since_str else None
+    except ValueError:
+        return jsonify({'error': '游标格式无效'}), 400
+
+    query = Order.query.options(db.selectinload(Order.items))
+    tombstone_query = OrderTombstone.query
+    if since:
+        # 使用 >= 比较，避免同一时间戳内后提交的修改被漏掉；边界上的记录可能重复下发，客户端按ID覆盖即可
+        query = query.filter(Order.updated_at >= since)
+        tombstone_query = tombstone_query.filter(OrderTombstone.deleted_at >= since)
+
+    orders = query.order_by(Order.updated_at).all()
+    tombstones = tombstone_query.order_by(OrderTombstone.deleted_at).all()
+
+    # 新游标取本次返回记录中的最大时间戳，没有变化时保持不变。
+    # 修改时间在提交前写入，事务可能等锁一段时间才提交，游标最多推进到当前时间之前的安全间隔，
+    # 间隔内的记录下次同步会再次下发，提交较晚的修改不会被跳过
+    timestamps = [order.updated_at for order in orders if order.updated_at]
+    timestamps += [tombstone.deleted_at for tombstone in tombstones]
+    cursor = since
+    if timestamps:
+        safe_cursor = datetime.utcnow() - timedelta(seconds=app.config.get('ORDER_CHANGES_SAFETY_LAG_SECONDS', 60))
+        cursor = min(max(timestamps), safe_cursor)
+        if since and cursor < since:
+            cursor = since
+
+    return jsonify({
+        'orders': [order_to_dict(order) for order in orders],
+        'deleted': [{
+            'id': tombstone.order_id,
+            'orderNumber': tombstone.order_number,
+            'deletedAt': tombstone.deleted_at.isoformat()
+        } for tombstone in tombstones],
+        'cursor': cursor.isoformat() if cursor else None
+    })
+
+@app.route('/api/orders/<int:order_id>', methods=['GET'])
+def get_order(order_id):
+    """按ID查询订单，热表中没有时查询归档表"""
+    order = db.session.get(Order, order_id)
+    archived = False
+    if order is None:
+        order = OrderArchive.query.get_or_404(order_id)
+        archived = True
+    return jsonify(dict(order_to_dict(order), archived=archived))
+
+@app.route('/api/orders/number/<order_number>', methods=['GET'])
+def get_order_by_number(order_number):
+    """按订单编号查询订单，热表中没有时查询归档表"""
+    order = Order.query.filter_by(order_number=order_number).first()
+    archived = False
+    if order is None:
+        order = OrderArchive.query.filter_by(order_number=order_number).first_or_404()
+        archived = True
+    return jsonify(dict(order_to_dict(order), archived=archived))
+
+@app.route('/api/orders/stream', methods=['GET'])
+def stream_orders():
+    """通过SSE推送订单新增、修改和删除事件"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    # 先订阅再补发，避免补发查询与实时推送之间漏掉事件
+    order_event_hub = order_event_hub_for(g.store_id)
+    subscriber = order_event_hub.subscribe()
+    backlog = []
+    if last_event_id and last_event_id.isdigit():
+        # 除了Last-Event-ID之后的事件，再补发回看时间内的事件：ID较小但提交较晚的事件可能在断线前还没有推送。
+        # 补发的事件可能与客户端已收到的重复，客户端按订单ID覆盖即可
+        lookback = datetime.utcnow() - timedelta(seconds=app.config.get('ORDER_EVENT_LOOKBACK_SECONDS', 60))
+        backlog = [order_event_to_dict(event) for event in OrderEvent.query.filter(db.or_(
+            OrderEvent.id > int(last_event_id),
+            OrderEvent.created_at >= lookback
+        )).order_by(OrderEvent.id).limit(1000).all()]
+    # 事件中心每个事件只推送一次，只需跳过补发中已经发送过的
+    backlog_ids = {event['id'] for event in backlog}
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            for event in backlog:
+                yield format_sse(event)
+            while not subscriber.overflowed:
+                try:
+                    event = subscriber.queue.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if event['id'] in backlog_ids:
+                    continue
+                yield format_sse(event)
+        finally:
+            order_event_hub.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# 辅助函数，生成今天接下来的count个订单编号
+def next_order_numbers(count=1):
     now = datetime.now()
     today_str = now.strftime('%Y%m%d')
     prefix = f"TB{today_str}"
-    # 查询今天所有订单编号，找最大后缀
-    today_orders = Order.query.filter(Order.order_number.like(f'{prefix}%')).all()
+    # 查询今天所有订单编号，找最大后缀（超过999单后后缀会多于3位）
+    today_numbers = db.session.query(Order.order_number).filter(Order.order_number.like(f'{prefix}%')).all()
     max_suffix = 0
-    for order in today_orders:
+    for (order_number,) in today_numbers:
         try:
-            suffix = int(order.order_number[-3:])
+            suffix = int(order_number[len(prefix):])
             if suffix > max_suffix:
                 max_suffix = suffix
         except Exception:
             continue
-    order_number = f"{prefix}{str(max_suffix + 1).zfill(3)}"
+    return [f"{prefix}{str(max_suffix + i).zfill(3)}" for i in range(1, count + 1)]
+
+# 辅助函数，从下单请求数据中取出订单和订单项的字段
+def order_fields_from_request(data):
+    items_subtotal = round(sum(item_data['price'] * item_data['quantity'] for item_data in data['items']), 2)
+    order_fields = {
+        'customer_name': data['customerName'],
+        'phone': data['phone'],
+        'address': data.get('address'),
+        'pickup_time': datetime.fromisoformat(data['pickupTime']) if data.get('pickupTime') else None,
+        'payment_method': data['paymentMethod'],
+        'status': data.get('status', 'pending'),
+        'discount': data.get('discount', 0.0),
+        'delivery_fee': data.get('deliveryFee', 0.0),
+        # 与修改订单相同，总金额由服务端根据订单项小计计算，不使用客户端传入的totalAmount
+        'total_amount': calc_order_total(items_subtotal, data.get('discount', 0.0), data.get('deliveryFee', 0.0)),
+        'notes': data.get('notes'),
+        'item_count': sum(item_data['quantity'] for item_data in data['items']),
+        'items_subtotal': items_subtotal
+    }
+    bread_ids = resolve_bread_ids(data['items'])
+    item_fields = [{
+        'bread_id': bread_id,
+        'name': item_data['name'],
+        'bread_type': item_data['breadType'],
+        'price': item_data['price'],
+        'quantity': item_data['quantity']
+    } for item_data, bread_id in zip(data['items'], bread_ids)]
+    return order_fields, item_fields
+
+# 辅助函数，在一个事务中写入多个订单：订单和订单项各一条多行INSERT，返回 [(订单ID, 订单编号)]
+def write_orders(entries):
+    order_numbers = next_order_numbers(len(entries))
+    
+    customer_ids = {}
+    order_rows = []
+    for (order_fields, _), order_number in zip(entries, order_numbers):
+        phone = normalize_phone(order_fields['phone'])
+        if phone and phone not in customer_ids:
+            customer_ids[phone] = get_or_create_customer(phone, order_fields['customer_name']).id
+        order_rows.append(dict(order_fields, order_number=order_number, customer_id=customer_ids.get(phone)))
+    db.session.execute(db.insert(Order), order_rows)
+    
+    # 多行INSERT拿不到各行的自增ID，按订单编号查回
+    order_ids = dict(db.session.query(Order.order_number, Order.id)
+                     .filter(Order.order_number.in_(order_numbers)).all())
+    item_rows = [dict(fields, order_id=order_ids[order_number])
+                 for (_, item_fields), order_number in zip(entries, order_numbers)
+                 for fields in item_fields]
+    if item_rows:
+        db.session.execute(db.insert(OrderItem), item_rows)
+    
+    refresh_customer_stats(customer_ids.values())
+    orders = Order.query.options(db.selectinload(Order.items)).filter(Order.id.in_(order_ids.values())).all()
+    db.session.add_all(OrderEvent(order_id=order.id, event_type='created', payload=order_to_dict(order))
+                       for order in orders)
+    sales = [(order.id, order.order_date, [(item.bread_id, item.name, item.quantity) for item in order.items])
+             for order in orders if order.status != 'cancelled']
+    db.session.commit()
+    
+    for order_id, order_date, items in sales:
+        best_seller_board_for(store_id_or_default()).record(order_id, order_date, items)
+    return [(order_ids[order_number], order_number) for order_number in order_numbers]
+
+class PendingOrder:
+    def __init__(self, store_id, order_fields, item_fields):
+        self.store_id = store_id
+        self.order_fields = order_fields
+        self.item_fields = item_fields
+        self.future = Future()
+
+# 订单写入合并器：每个worker一个写入线程，把短时间内到达的下单请求合并为一个事务提交，
+# 高峰期多个订单共用一次提交（一次fsync），请求线程等待所在批次提交后拿到各自的订单ID
+class OrderWriteBatcher:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, order_fields, item_fields):
+        pending = PendingOrder(store_id_or_default(), order_fields, item_fields)
+        with self._lock:
+            # 首次下单时才启动写入线程，避免gunicorn预加载时在主进程中创建线程
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='order-write-batcher', daemon=True)
+                self._thread.start()
+        self._queue.put(pending)
+        return pending.future
+
+    def _run(self):
+        window = app.config.get('ORDER_BATCH_WINDOW_MS', 5) / 1000
+        max_size = app.config.get('ORDER_BATCH_MAX_SIZE', 50)
+        with app.app_context():
+            while True:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + window
+                while len(batch) < max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                
+                # 每个门店的订单分别在该门店的数据库中提交
+                by_store = {}
+                for pending in batch:
+                    # 请求等待超时后已取消的订单不再写入
+                    if not pending.future.set_running_or_notify_cancel():
+                        continue
+                    by_store.setdefault(pending.store_id, []).append(pending)
+                for store_id, store_batch in by_store.items():
+                    g.store_id = store_id
+                    self._flush(store_batch)
+
+    def _flush(self, batch):
+        try:
+            results = write_orders([(pending.order_fields, pending.item_fields) for pending in batch])
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+            else:
+                # 整批失败时逐个重试，避免一个订单的错误影响同批的其他订单
+                for pending in batch:
+                    self._flush([pending])
+            return
+        finally:
+            db.session.remove()
+        for pending, result in zip(batch, results):
+            pending.future.set_result(result)
+
+order_write_batcher = OrderWriteBatcher()
+
+@app.route('/api/orders', methods=['POST'])
+@idempotent('orders')
+def create_order():
+    data = request.json
+    try:
+        order_fields, item_fields = order_fields_from_request(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # 开启写入合并时交给写入线程，与同一时间的其他订单一起提交
+    if app.config.get('ORDER_WRITE_BATCHING'):
+        # 等待期间先归还连接，否则并发请求占满连接池后写入线程拿不到连接
+        db.session.close()
+        future = order_write_batcher.submit(order_fields, item_fields)
+        wait_seconds = app.config.get('ORDER_BATCH_WAIT_SECONDS', 30)
+        try:
+            order_id, order_number = future.result(timeout=wait_seconds)
+        except FutureTimeoutError:
+            # 还没轮到写入的订单取消后返回503，客户端重试不会产生重复订单；已开始写入的无法取消，等待其提交结果
+            if future.cancel():
+                response = jsonify({'error': '下单繁忙，请稍后重试'})
+                response.headers['Retry-After'] = '1'
+                return response, 503
+            order_id, order_number = future.result()
+        return jsonify({
+            'message': '订单创建成功',
+            'id': order_id,
+            'orderNumber': order_number
+        }), 201
     
     # 创建订单
-    order = Order(
-        order_number=order_number,
-        customer_name=data['customerName'],
-        phone=data['phone'],
-        address=data.get('address'),
-        pickup_time=datetime.fromisoformat(data['pickupTime']) if data.get('pickupTime') else None,
-        payment_method=data['paymentMethod'],
-        status=data.get('status', 'pending'),
-        discount=data.get('discount', 0.0),
-        delivery_fee=data.get('deliveryFee', 0.0),
-        total_amount=data['totalAmount'],
-        notes=data.get('notes')
-    )
+    order = Order(order_number=next_order_numbers()[0], **order_fields)
     db.session.add(order)
     
     # 添加订单项
-    for item_data in data['items']:
-        item = OrderItem(
-            name=item_data['name'],
-            bread_type=item_data['breadType'],
-            price=item_data['price'],
-            quantity=item_data['quantity']
-        )
-        order.items.append(item)
+    for fields in item_fields:
+        order.items.append(OrderItem(**fields))
     
+    link_customer(order)
+    refresh_customer_stats([order.customer_id])
+    record_order_event(order, 'created')
     db.session.commit()
+    if order.status != 'cancelled':
+        best_seller_board_for(order.store_id).record(order.id, order.order_date, [(item.bread_id, item.name, item.quantity) for item in order.items])
     return jsonify({
         'message': '订单创建成功',
         'id': order.id,
@@ -610,6 +1979,13 @@ def update_order(order_id):
     order = Order.query.get_or_404(order_id)
     data = request.json
     
+    # 先校验订单项中的面包，校验失败时不修改订单
+    if 'items' in data:
+        try:
+            bread_ids = resolve_bread_ids(data['items'])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
     # 更新订单基本信息
     order.customer_name = data.get('customerName', order.customer_name)
     order.phone = data.get('phone', order.phone)
@@ -619,32 +1995,80 @@ def update_order(order_id):
     order.status = data.get('status', order.status)
     order.discount = data.get('discount', order.discount)
     order.delivery_fee = data.get('deliveryFee', order.delivery_fee)
-    order.total_amount = data.get('totalAmount', order.total_amount)
     order.notes = data.get('notes', order.notes)
     
-    # 更新订单项
+    # 电话可能变化，重新关联客户
+    previous_customer_id = order.customer_id
+    link_customer(order)
+    
+    # 更新订单项：按ID比对，只更新有变化的行，新增和删除分别批量执行
     if 'items' in data:
-        # 删除现有订单项
-        for item in order.items:
-            db.session.delete(item)
+        existing_items = {item.id: item for item in order.items}
+        kept_ids = set()
+        changed_rows = []
+        new_rows = []
+        subtotal = 0
+        
+        for item_data, bread_id in zip(data['items'], bread_ids):
+            row = {
+                'bread_id': bread_id,
+                'name': item_data['name'],
+                'bread_type': item_data['breadType'],
+                'price': item_data['price'],
+                'quantity': item_data['quantity']
+            }
+            subtotal += row['price'] * row['quantity']
+            
+            item = existing_items.get(item_data.get('id'))
+            if item is None or item.id in kept_ids:
+                # 没有ID或ID不属于该订单的视为新增
+                new_rows.append(dict(row, order_id=order.id))
+                continue
+            
+            kept_ids.add(item.id)
+            if any(getattr(item, key) != value for key, value in row.items()):
+                changed_rows.append(dict(row, id=item.id))
         
-        # 添加新订单项
-        for item_data in data['items']:
-            item = OrderItem(
-                name=item_data['name'],
-                bread_type=item_data['breadType'],
-                price=item_data['price'],
-                quantity=item_data['quantity']
-            )
-            order.items.append(item)
+        removed_ids = [item_id for item_id in existing_items if item_id not in kept_ids]
+        
+        if removed_ids:
+            OrderItem.query.filter(OrderItem.id.in_(removed_ids)).delete(synchronize_session=False)
+        if changed_rows:
+            db.session.execute(db.update(OrderItem), changed_rows)
+        if new_rows:
+            db.session.execute(db.insert(OrderItem), new_rows)
+        
+        # 批量语句不会同步会话中的对象，移除已删除的订单项并让关系在下次访问时重新加载
+        for item_id in removed_ids:
+            db.session.expunge(existing_items[item_id])
+        db.session.expire(order, ['items'])
+        
+        order.item_count = sum(item_data['quantity'] for item_data in data['items'])
+        order.items_subtotal = round(subtotal, 2)
     
+    # 未回填小计的旧订单按现有订单项现算，避免把总金额误算成只剩折扣和配送费
+    if order.items_subtotal is None:
+        order.items_subtotal = round(sum(item.price * item.quantity for item in order.items), 2)
+        order.item_count = sum(item.quantity for item in order.items)
+    
+    # 订单总金额由服务端根据订单项小计重新计算，不再信任客户端传入的值
+    order.total_amount = calc_order_total(order.items_subtotal, order.discount, order.delivery_fee)
+    refresh_customer_stats([previous_customer_id, order.customer_id])
+    
+    # 订单项变化不会触发订单行的onupdate，显式刷新修改时间
+    order.updated_at = datetime.utcnow()
+    record_order_event(order, 'updated')
     db.session.commit()
     return jsonify({'message': '订单更新成功'})
 
 @app.route('/api/orders/<int:order_id>', methods=['DELETE'])
 def delete_order(order_id):
     order = Order.query.get_or_404(order_id)
+    db.session.add(OrderTombstone(order_id=order.id, order_number=order.order_number))
+    record_order_event(order, 'deleted')
     db.session.delete(order)
+    db.session.flush()
+    refresh_customer_stats([order.customer_id])
     db.session.commit()
     return jsonify({'message': '订单删除成功'})
 
@@ -653,9 +2077,210 @@ def update_order_status(order_id):
     order = Order.query.get_or_404(order_id)
     data = request.json
     order.status = data['status']
+    db.session.flush()
+    refresh_customer_stats([order.customer_id])
+    record_order_event(order, 'status')
     db.session.commit()
     return jsonify({'message': '订单状态更新成功'})
 
+# 订单状态允许的流转：已完成和已取消的订单不能再变更
+ORDER_STATUS_TRANSITIONS = {
+    'pending': {'processing', 'completed', 'cancelled'},
+    'processing': {'completed', 'cancelled'},
+    'completed': set(),
+    'cancelled': set()
+}
+
+@app.route('/api/orders/status', methods=['PUT'])
+def update_orders_status():
+    """批量更新订单状态，返回每个订单的处理结果"""
+    data = request.json
+    target_status = data.get('status')
+    order_ids = list(dict.fromkeys(order_id for order_id in data.get('ids', []) if isinstance(order_id, int)))
+    
+    if target_status not in ORDER_STATUS_TRANSITIONS:
+        return jsonify({'message': '订单状态无效'}), 400
+    if not order_ids:
+        return jsonify({'message': '未提供订单ID'}), 400
+    
+    # 一次查询取出所有订单的当前状态
+    current_status = dict(db.session.query(Order.id, Order.status).filter(Order.id.in_(order_ids)).all())
+    
+    results = {}
+    candidate_ids = []
+    for order_id in order_ids:
+        status = current_status.get(order_id)
+        if order_id not in current_status:
+            results[order_id] = {'id': order_id, 'result': 'not_found', 'previousStatus': None}
+        elif status == target_status:
+            results[order_id] = {'id': order_id, 'result': 'unchanged', 'previousStatus': status}
+        elif target_status not in ORDER_STATUS_TRANSITIONS.get(status, set()):
+            results[order_id] = {'id': order_id, 'result': 'rejected', 'previousStatus': status}
+        else:
+            results[order_id] = {'id': order_id, 'result': 'updated', 'previousStatus': status}
+            candidate_ids.append(order_id)
+    
+    if candidate_ids:
+        # 一条UPDATE完成所有变更，WHERE中再次校验来源状态，防止并发修改绕过流转规则
+        source_status = [status for status, targets in ORDER_STATUS_TRANSITIONS.items() if target_status in targets]
+        updated_count = Order.query.filter(
+            Order.id.in_(candidate_ids),
+            Order.status.in_(source_status)
+        ).update({'status': target_status, 'updated_at': datetime.utcnow()}, synchronize_session=False)
+        
+        updated_orders = Order.query.options(db.selectinload(Order.items)) \
+            .filter(Order.id.in_(candidate_ids)).all()
+        if updated_count != len(candidate_ids):
+            # 部分订单在查询后被并发修改，以最新状态为准标记为拒绝
+            for order in updated_orders:
+                if order.status != target_status:
+                    results[order.id].update(result='rejected', previousStatus=order.status)
+            updated_orders = [order for order in updated_orders if order.status == target_status]
+            for order_id in set(candidate_ids) - {order.id for order in updated_orders}:
+                if results[order_id]['result'] == 'updated':
+                    results[order_id]['result'] = 'not_found'
+        
+        for order in updated_orders:
+            record_order_event(order, 'status')
+        refresh_customer_stats({order.customer_id for order in updated_orders})
+    
+    db.session.commit()
+    result_list = list(results.values())
+    return jsonify({
+        'message': '订单状态批量更新完成',
+        'updated': sum(1 for result in result_list if result['result'] == 'updated'),
+        'rejected': [result['id'] for result in result_list if result['result'] in ('rejected', 'not_found')],
+        'results': result_list
+    })
+
+# 客户相关接口
+def customer_to_dict(customer):
+    return {
+        'id': customer.id,
+        'phone': customer.phone,
+        'name': customer.name,
+        'orderCount': customer.order_count,
+        'totalSpend': customer.total_spend,
+        'firstOrderDate': customer.first_order_date.isoformat() if customer.first_order_date else None,
+        'lastOrderDate': customer.last_order_date.isoformat() if customer.last_order_date else None
+    }
+
+@app.route('/api/customers', methods=['GET'])
+def get_customers():
+    """按累计消费或最近下单时间列出客户"""
+    sort = request.args.get('sort', 'totalSpend')
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+    order_by = Customer.last_order_date.desc() if sort == 'lastOrderDate' else Customer.total_spend.desc()
+    customers = Customer.query.order_by(order_by).limit(limit).all()
+    return jsonify([customer_to_dict(customer) for customer in customers])
+
+@app.route('/api/customers/lookup', methods=['GET'])
+def lookup_customer():
+    """按电话号码查找客户"""
+    phone = normalize_phone(request.args.get('phone', ''))
+    if not phone:
+        return jsonify({'error': '电话号码无效'}), 400
+    customer = Customer.query.filter_by(phone=phone).first_or_404()
+    return jsonify(customer_to_dict(customer))
+
+@app.route('/api/customers/<int:customer_id>', methods=['GET'])
+def get_customer(customer_id):
+    customer = Customer.query.get_or_404(customer_id)
+    return jsonify(customer_to_dict(customer))
+
+@app.route('/api/customers/<int:customer_id>/orders', methods=['GET'])
+def get_customer_orders(customer_id):
+    """客户的历史订单，按下单时间倒序，包含已归档订单"""
+    Customer.query.get_or_404(customer_id)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    
+    orders = Order.query.filter_by(customer_id=customer_id) \
+        .order_by(Order.order_date.desc()).limit(limit).all()
+    if len(orders) < limit:
+        orders += OrderArchive.query.filter_by(customer_id=customer_id) \
+            .order_by(OrderArchive.order_date.desc()).limit(limit - len(orders)).all()
+    
+    return jsonify([order_to_dict(order, include_items=False) for order in orders])
+
+# 密码哈希线程池：限制同时计算的哈希数量，登录高峰时不占满CPU，其他请求不必排在哈希计算之后
+class PasswordHasher:
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = None
+
+    def _start(self):
+        with self._lock:
+            # 首次使用时才创建线程池，避免gunicorn预加载时在主进程中创建线程
+            if self._executor is None:
+                self._slots = threading.BoundedSemaphore(app.config.get('PASSWORD_HASH_MAX_PENDING', 32))
+                self._executor = ThreadPoolExecutor(max_workers=app.config.get('PASSWORD_HASH_WORKERS', 2),
+                                                    thread_name_prefix='password-hash')
+
+    def run(self, func, *args):
+        """在线程池中执行哈希计算并等待结果，排队已满时返回None"""
+        if self._executor is None:
+            self._start()
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+password_hasher = PasswordHasher()
+
+# 辅助函数，当前配置下生成的哈希前缀（算法和参数），用于判断已有密码是否需要重新哈希；
+# 按werkzeug的规则由配置字符串补全省略的参数，不实际计算一次哈希
+def password_hash_prefix(method):
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return f'scrypt:{n}:{r}:{p}'
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    return method
+
+def password_needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != password_hash_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+# 登录令牌：签名中包含用户ID、角色和门店，有效期内验证令牌无需查询用户表
+def auth_serializer():
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='auth-token')
+
+def issue_auth_token(user):
+    return auth_serializer().dumps({'id': user.id, 'username': user.username, 'role': user.role, 'storeId': user.store_id})
+
+@app.before_request
+def load_current_user():
+    g.current_user = None
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return
+    try:
+        payload = auth_serializer().loads(auth_header[7:], max_age=app.config.get('AUTH_TOKEN_MAX_AGE', 7200))
+    except BadSignature:
+        return  # 令牌无效或已过期时按未登录处理
+    # 令牌只在签发时的门店内有效
+    if payload.get('storeId') == g.get('store_id'):
+        g.current_user = payload
+
+# 辅助函数，检查当前请求是否由管理员发起，不是时返回错误响应，是则返回None
+def require_admin():
+    if g.current_user is None:
+        return jsonify({'message': '未登录或登录已过期'}), 401
+    if g.current_user.get('role') != 'admin':
+        return jsonify({'message': '需要管理员权限'}), 403
+    return None
+
 # 获取所有用户
 @app.route('/api/users', methods=['GET'])
 def get_users():
@@ -679,9 +2304,13 @@ def register_user():
     if User.query.filter_by(email=data['email']).first():
         return jsonify({'message': '邮箱已存在'}), 400
     
+    password_hash = password_hasher.hash(data['password'])
+    if password_hash is None:
+        return jsonify({'message': '服务繁忙，请稍后重试'}), 503
+    
     user = User(
         username=data['username'],
-        password=generate_password_hash(data['password']),
+        password=password_hash,
         email=data['email'],
         phone=data.get('phone', ''),
         role=data.get('role', 'staff'),
@@ -730,14 +2359,40 @@ def delete_user(user_id):
 def login_user():
     data = request.json
     user = User.query.filter_by(username=data['username']).first()
-    if user and check_password_hash(user.password, data['password']):
-        return jsonify({
-            'message': '登录成功',
-            'id': user.id,
-            'username': user.username,
-            'role': user.role
-        })
-    return jsonify({'message': '用户名或密码错误'}), 401
+    if user is None:
+        return jsonify({'message': '用户名或密码错误'}), 401
+    
+    # 哈希计算期间不持有数据库连接；关闭会话后user已加载的属性仍可读取
+    password_hash = user.password
+    db.session.close()
+    matched = password_hasher.check(password_hash, data['password'])
+    if matched is None:
+        return jsonify({'message': '登录繁忙，请稍后重试'}), 503
+    if not matched:
+        return jsonify({'message': '用户名或密码错误'}), 401
+    
+    # 哈希参数变化后，用本次登录的明文按新参数重新哈希
+    if password_needs_rehash(password_hash):
+        new_hash = password_hasher.hash(data['password'])
+        if new_hash is not None:
+            User.query.filter_by(id=user.id).update({'password': new_hash}, synchronize_session=False)
+            db.session.commit()
+    
+    return jsonify({
+        'message': '登录成功',
+        'id': user.id,
+        'username': user.username,
+        'role': user.role,
+        'token': issue_auth_token(user),
+        'expiresIn': app.config.get('AUTH_TOKEN_MAX_AGE', 7200)
+    })
+
+# 当前登录用户，只验证令牌签名，不查询用户表
+@app.route('/api/users/me', methods=['GET'])
+def get_current_user():
+    if g.current_user is None:
+        return jsonify({'message': '未登录或登录已过期'}), 401
+    return jsonify(g.current_user)
 
 # 财务分析相关接口
 @app.route('/api/finance/monthly-summary', methods=['GET'])
@@ -763,18 +2418,10 @@ def get_monthly_summary():
         prev_month_end = start_date - timedelta(days=1)
     
     # 获取当前月的订单数据（收入）
-    current_orders = Order.query.filter(
-        Order.order_date >= start_date,
-        Order.order_date <= end_date,
-        Order.status == 'completed'
-    ).all()
+    current_orders = completed_orders_between(start_date, end_date)
     
     # 获取上个月的订单数据（收入）
-    prev_orders = Order.query.filter(
-        Order.order_date >= prev_month_start,
-        Order.order_date <= prev_month_end,
-        Order.status == 'completed'
-    ).all()
+    prev_orders = completed_orders_between(prev_month_start, prev_month_end)
     
     # 获取当前月的支出数据
     current_expenses = Expense.query.filter(
@@ -849,11 +2496,7 @@ def get_finance_trends():
             end_date = datetime(target_year, target_month + 1, 1) - timedelta(days=1)
         
         # 获取该月的订单数据（收入）
-        orders = Order.query.filter(
-            Order.order_date >= start_date,
-            Order.order_date <= end_date,
-            Order.status == 'completed'
-        ).all()
+        orders = completed_orders_between(start_date, end_date)
         
         # 获取该月的支出数据
         expenses = Expense.query.filter(
@@ -909,11 +2552,7 @@ def get_income_composition():
         return jsonify({'error': '日期格式无效'}), 400
     
     # 获取指定日期范围的已完成订单
-    orders = Order.query.filter(
-        Order.order_date >= start_date,
-        Order.order_date <= end_date,
-        Order.status == 'completed'
-    ).all()
+    orders = completed_orders_between(start_date, end_date)
     
     # 统计不同面包类型的销售额
     bread_sales = {}
@@ -1027,11 +2666,7 @@ def get_transactions():
         return jsonify({'error': '日期格式无效'}), 400
     
     # 获取订单数据（收入）
-    orders = Order.query.filter(
-        Order.order_date >= start_date,
-        Order.order_date <= end_date,
-        Order.status == 'completed'
-    ).all()
+    orders = completed_orders_between(start_date, end_date)
     
     # 获取支出数据
     expenses = Expense.query.filter(
@@ -1068,6 +2703,524 @@ def get_transactions():
     
     return jsonify(transactions)
 
+# 辅助函数，按天、按面包ID汇总已完成订单的销量，日期范围为 [start_date, end_date)
+def daily_bread_sales(start_date, end_date):
+    tables = [(Order, OrderItem)]
+    if range_reaches_archive(start_date):
+        tables.append((OrderArchive, OrderItemArchive))
+    
+    rows = []
+    for order_model, item_model in tables:
+        day = db.func.date(order_model.order_date)
+        rows += db.session.query(
+            day,
+            item_model.bread_id,
+            db.func.sum(item_model.quantity)
+        ).join(order_model, order_model.id == item_model.order_id).filter(
+            item_model.bread_id.isnot(None),
+            order_model.order_date >= start_date,
+            order_model.order_date < end_date,
+            order_model.status == 'completed'
+        ).group_by(day, item_model.bread_id).all()
+    
+    # MySQL返回date对象，SQLite返回字符串，统一为YYYY-MM-DD
+    return [(str(day)[:10], bread_id, quantity or 0) for day, bread_id, quantity in rows]
+
+# 配方矩阵缓存：按门店缓存，面包数量或最后修改时间变化时才重新解析配方
+_recipe_matrix_cache = {}
+
+def get_recipe_matrix():
+    store_id = store_id_or_default()
+    version = tuple(db.session.query(db.func.count(Bread.id), db.func.max(Bread.updated_at)).one())
+    cached = _recipe_matrix_cache.get(store_id)
+    if cached is None or cached[0] != version:
+        recipes = dict(db.session.query(Bread.id, Bread.ingredients).all())
+        cached = _recipe_matrix_cache[store_id] = (version, build_recipe_matrix(recipes))
+    return cached[1]
+
+@app.route('/api/finance/ingredient-consumption', methods=['GET'])
+def get_ingredient_consumption():
+    """根据销量和配方计算每日及总计的原料消耗"""
+    start_date_str = request.args.get('startDate', '')
+    end_date_str = request.args.get('endDate', '')
+    
+    try:
+        if start_date_str:
+            start_date = datetime.fromisoformat(start_date_str.split('T')[0])
+        else:
+            # 默认为当月1日
+            start_date = datetime(datetime.now().year, datetime.now().month, 1)
+        
+        if end_date_str:
+            end_date = datetime.fromisoformat(end_date_str.split('T')[0])
+        else:
+            # 默认为今天
+            end_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    except ValueError:
+        return jsonify({'error': '日期格式无效'}), 400
+    
+    bread_ids, ingredients, recipe_matrix = get_recipe_matrix()
+    bread_index = {bread_id: i for i, bread_id in enumerate(bread_ids)}
+    
+    # 结束日期当天包含在内
+    rows = [row for row in daily_bread_sales(start_date, end_date + timedelta(days=1)) if row[1] in bread_index]
+    days = sorted({row[0] for row in rows})
+    day_index = {day: i for i, day in enumerate(days)}
+    
+    # 构建 日期×面包 的销量矩阵，与 面包×原料 的配方矩阵相乘得到 日期×原料 的消耗
+    sales = np.zeros((len(days), len(bread_ids)))
+    if rows:
+        np.add.at(sales, (
+            np.array([day_index[row[0]] for row in rows]),
+            np.array([bread_index[row[1]] for row in rows])
+        ), np.array([row[2] for row in rows], dtype=float))
+    consumption = sales @ recipe_matrix
+    
+    return jsonify({
+        'ingredients': [{
+            'name': name,
+            'unit': unit,
+            'total': round(float(total), 2)
+        } for (name, unit), total in zip(ingredients, consumption.sum(axis=0))],
+        'daily': [{
+            'date': day,
+            'values': [round(float(value), 2) for value in consumption[i]]
+        } for i, day in enumerate(days)]
+    })
+
+# 把截至昨天的每日销量增量纳入预测模型，返回 (面包ID列表, 模型状态)
+def refresh_sales_forecast():
+    alpha = app.config.get('FORECAST_ALPHA', 0.3)
+    gamma = app.config.get('FORECAST_GAMMA', 0.2)
+    yesterday = datetime.utcnow().date() - timedelta(days=1)
+    
+    state_id = f'bread_daily_sales:{store_id_or_default()}'
+    record = db.session.get(ForecastState, state_id)
+    if record and record.state.get('params') == [alpha, gamma]:
+        bread_ids = record.state['bread_ids']
+        state = forecast.state_from_json(record.state['model'])
+        start = record.last_date + timedelta(days=1)
+    else:
+        # 首次计算或平滑参数变化时从最早的订单开始重新拟合
+        bread_ids = []
+        state = forecast.initial_state(0)
+        first_dates = [
+            db.session.query(db.func.min(Order.order_date)).scalar(),
+            db.session.query(db.func.min(OrderArchive.order_date)).scalar()
+        ]
+        first_dates = [first_date for first_date in first_dates if first_date]
+        # 还没有订单时没有可拟合的日期，同样保存状态，避免每次查询建议库存都再提交重算任务
+        start = min(first_dates).date() if first_dates else yesterday + timedelta(days=1)
+    
+    # 新增的面包追加到末尾，保持已有状态列的顺序
+    known_ids = set(bread_ids)
+    bread_ids = bread_ids + [bread_id for (bread_id,) in db.session.query(Bread.id).order_by(Bread.id) if bread_id not in known_ids]
+    state = forecast.extend_state(state, len(bread_ids))
+    
+    if start <= yesterday:
+        bread_index = {bread_id: i for i, bread_id in enumerate(bread_ids)}
+        rows = [row for row in daily_bread_sales(datetime.combine(start, datetime.min.time()),
+                                                 datetime.combine(yesterday + timedelta(days=1), datetime.min.time()))
+                if row[1] in bread_index]
+        
+        # 没有销量的日期也要作为0参与平滑
+        sales = np.zeros(((yesterday - start).days + 1, len(bread_ids)))
+        if rows:
+            np.add.at(sales, (
+                np.array([(datetime.fromisoformat(row[0]).date() - start).days for row in rows]),
+                np.array([bread_index[row[1]] for row in rows])
+            ), np.array([row[2] for row in rows], dtype=float))
+        state = forecast.update(state, sales, start.weekday(), alpha, gamma)
+    
+    # 首单在今天的新门店也要保存（last_date为昨天），已保存的状态没有新日期时不必重写
+    if start <= yesterday or record is None or record.state.get('params') != [alpha, gamma]:
+        if record is None:
+            record = ForecastState(id=state_id)
+            db.session.add(record)
+        record.state = {'params': [alpha, gamma], 'bread_ids': bread_ids, 'model': forecast.state_to_json(state)}
+        record.last_date = yesterday
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 其他进程同时首次拟合并已写入，以已保存的状态为准
+            db.session.rollback()
+            return load_sales_forecast()[:2]
+    
+    return bread_ids, state
+
+# 读取已保存的预测模型，返回 (面包ID列表, 模型状态, 已纳入模型的最后一天)，尚未拟合过时最后一天为None
+def load_sales_forecast():
+    record = db.session.get(ForecastState, f'bread_daily_sales:{store_id_or_default()}')
+    if record is None:
+        return [], forecast.initial_state(0), None
+    return record.state['bread_ids'], forecast.state_from_json(record.state['model']), record.last_date
+
+# 辅助函数，预测模型没有更新到昨天时提交一次重算任务，已有排队或执行中的重算任务时不重复提交
+def schedule_forecast_refresh(last_date):
+    if last_date is not None and last_date >= datetime.utcnow().date() - timedelta(days=1):
+        return False
+    if Job.query.filter(Job.kind == 'update-forecast', Job.status.in_(('queued', 'running'))).first():
+        return True
+    enqueue_job('update-forecast')
+    return True
+
+@app.cli.command('update-forecast')
+def update_forecast_command():
+    """把截至昨天的销量纳入预测模型，可由定时任务每天执行"""
+    for store_id, (bread_ids, state) in for_each_store(refresh_sales_forecast).items():
+        print(f'门店{store_id}预测模型已更新，共{len(bread_ids)}种面包，累计{state["observed_days"]}天')
+
+@app.route('/api/breads/restock-suggestions', methods=['GET'])
+def get_restock_suggestions():
+    """根据销量预测给出各面包的建议库存"""
+    date_str = request.args.get('date', '')
+    try:
+        target_date = datetime.fromisoformat(date_str).date() if date_str else datetime.utcnow().date()
+    except ValueError:
+        return jsonify({'error': '日期格式无效'}), 400
+    
+    # 重新拟合交给后台任务，请求中只读取最近一次保存的模型
+    bread_ids, state, last_date = load_sales_forecast()
+    refreshing = schedule_forecast_refresh(last_date)
+    predictions = dict(zip(bread_ids, forecast.predict(state, target_date.weekday()).tolist()))
+    safety_factor = app.config.get('FORECAST_SAFETY_FACTOR', 0.2)
+    
+    result = []
+    for bread in Bread.query.order_by(Bread.id).all():
+        predicted = predictions.get(bread.id, 0)
+        suggested = int(np.ceil(round(predicted * (1 + safety_factor), 6)))
+        result.append({
+            'breadId': bread.id,
+            'name': bread.name,
+            'stock': bread.stock,
+            'forecast': round(predicted, 1),
+            'suggestedStock': suggested,
+            'restock': max(suggested - (bread.stock or 0), 0)
+        })
+    
+    return jsonify({
+        'date': target_date.isoformat(),
+        'forecastThrough': last_date.isoformat() if last_date else None,
+        'refreshing': refreshing,
+        'suggestions': result
+    })
+
+# 辅助函数，按数据库方言生成 星期几（0为周一）和小时 的SQL表达式
+def weekday_hour_expressions(column):
+    if db.session.get_bind().dialect.name == 'mysql':
+        weekday = db.func.weekday(column)  # MySQL的WEEKDAY()以周一为0
+    else:
+        weekday = (db.extract('dow', column) + 6) % 7  # SQLite等以周日为0，转换为周一为0
+    return weekday, db.extract('hour', column)
+
+# 计算 星期×小时 的订单数和收入，日期范围为 [start_date, end_date)
+def sales_heatmap(start_date, end_date):
+    orders = [[0] * 24 for _ in range(7)]
+    revenue = [[0.0] * 24 for _ in range(7)]
+    
+    tables = [Order]
+    if range_reaches_archive(start_date):
+        tables.append(OrderArchive)
+    
+    for order_model in tables:
+        weekday, hour = weekday_hour_expressions(order_model.order_date)
+        rows = db.session.query(
+            weekday,
+            hour,
+            db.func.count(order_model.id),
+            db.func.sum(order_model.total_amount)
+        ).filter(
+            order_model.order_date >= start_date,
+            order_model.order_date < end_date,
+            order_model.status == 'completed'
+        ).group_by(weekday, hour).all()
+        
+        for weekday_value, hour_value, count, amount in rows:
+            orders[int(weekday_value)][int(hour_value)] += count
+            revenue[int(weekday_value)][int(hour_value)] += amount or 0
+    
+    return {
+        'orders': orders,
+        'revenue': [[round(amount, 2) for amount in row] for row in revenue]
+    }
+
+# 已结束日期范围的热力图按门店缓存（查询本身由当前门店条件过滤，store_id用于区分缓存）。
+# 历史订单仍可能改状态、修改或删除，缓存键带上该范围订单的数据版本，版本变化时重新计算
+@lru_cache(maxsize=256)
+def cached_sales_heatmap(store_id, start_date, end_date, version):
+    return sales_heatmap(start_date, end_date)
+
+# 辅助函数，日期范围内订单的数据版本：订单数和最后修改时间，归档表用归档时间
+def sales_heatmap_version(start_date, end_date):
+    version = db.session.query(db.func.count(Order.id), db.func.max(Order.updated_at)).filter(
+        Order.order_date >= start_date,
+        Order.order_date < end_date
+    ).one()
+    if range_reaches_archive(start_date):
+        version += db.session.query(db.func.count(OrderArchive.id), db.func.max(OrderArchive.archived_at)).filter(
+            OrderArchive.order_date >= start_date,
+            OrderArchive.order_date < end_date
+        ).one()
+    return tuple(version)
+
+@app.route('/api/finance/sales-heatmap', methods=['GET'])
+def get_sales_heatmap():
+    """获取按星期和小时分布的订单数与收入"""
+    start_date_str = request.args.get('startDate', '')
+    end_date_str = request.args.get('endDate', '')
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    
+    try:
+        if start_date_str:
+            start_date = datetime.fromisoformat(start_date_str.split('T')[0])
+        else:
+            # 默认为最近4周
+            start_date = today - timedelta(days=28)
+        
+        if end_date_str:
+            end_date = datetime.fromisoformat(end_date_str.split('T')[0])
+        else:
+            # 默认为今天
+            end_date = today
+    except ValueError:
+        return jsonify({'error': '日期格式无效'}), 400
+    
+    # 结束日期当天包含在内
+    end_date += timedelta(days=1)
+    if end_date <= today:
+        result = cached_sales_heatmap(g.store_id, start_date, end_date, sales_heatmap_version(start_date, end_date))
+    else:
+        result = sales_heatmap(start_date, end_date)
+    
+    return jsonify(dict(result, weekdays=['周一', '周二', '周三', '周四', '周五', '周六', '周日'], hours=list(range(24))))
+
+# 数据导出：每种导出返回表头和逐行生成的数据，数据通过服务端游标分批读取
+def export_orders(start_date, end_date):
+    header = ['订单编号', '下单时间', '客户姓名', '联系电话', '配送地址', '支付方式', '订单状态',
+              '折扣金额', '配送费', '订单总金额', '面包件数', '备注']
+    tables = [Order, OrderArchive] if range_reaches_archive(start_date) else [Order]
+    
+    def rows():
+        for order_model in tables:
+            result = db.session.execute(db.select(
+                order_model.order_number, order_model.order_date, order_model.customer_name,
+                order_model.phone, order_model.address, order_model.payment_method, order_model.status,
+                order_model.discount, order_model.delivery_fee, order_model.total_amount,
+                order_model.item_count, order_model.notes
+            ).where(
+                order_model.order_date >= start_date,
+                order_model.order_date < end_date
+            ).order_by(order_model.order_date).execution_options(yield_per=1000))
+            yield from result
+    
+    return header, rows()
+
+def export_order_items(start_date, end_date):
+    header = ['订单编号', '下单时间', '客户姓名', '支付方式', '订单状态', '订单总金额',
+              '面包ID', '面包名称', '面包类型', '单价', '数量', '小计']
+    tables = [(Order, OrderItem)]
+    if range_reaches_archive(start_date):
+        tables.append((OrderArchive, OrderItemArchive))
+    
+    def rows():
+        # 订单与订单项连接后一次读出，每个订单项一行
+        for order_model, item_model in tables:
+            result = db.session.execute(db.select(
+                order_model.order_number, order_model.order_date, order_model.customer_name,
+                order_model.payment_method, order_model.status, order_model.total_amount,
+                item_model.bread_id, item_model.name, item_model.bread_type,
+                item_model.price, item_model.quantity
+            ).join(item_model, item_model.order_id == order_model.id).where(
+                order_model.order_date >= start_date,
+                order_model.order_date < end_date
+            ).order_by(order_model.order_date, item_model.id).execution_options(yield_per=1000))
+            for row in result:
+                yield tuple(row) + (round(row.price * row.quantity, 2),)
+    
+    return header, rows()
+
+def export_expenses(start_date, end_date):
+    header = ['支出日期', '支出类别', '支出金额', '备注', '创建人', '记录时间']
+    
+    def rows():
+        yield from db.session.execute(db.select(
+            Expense.expense_date, Expense.category, Expense.amount,
+            Expense.note, Expense.created_by, Expense.created_at
+        ).where(
+            Expense.expense_date >= start_date,
+            Expense.expense_date < end_date
+        ).order_by(Expense.expense_date).execution_options(yield_per=1000))
+    
+    return header, rows()
+
+EXPORTS = {
+    'orders': export_orders,
+    'order-items': export_order_items,
+    'expenses': export_expenses
+}
+
+# 把表头和数据行逐块编码为CSV，可选gzip压缩，内存占用与总行数无关
+def iter_csv(header, rows, compress=False, chunk_size=64 * 1024):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 生成gzip格式
+    
+    def encode(text, final=False):
+        data = text.encode('utf-8')
+        if compressor is None:
+            return data
+        data = compressor.compress(data)
+        return data + compressor.flush() if final else data
+    
+    buffer.write('\ufeff')  # BOM，Excel打开时正确识别中文
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([value.isoformat() if isinstance(value, datetime) else value for value in row])
+        if buffer.tell() >= chunk_size:
+            chunk = encode(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+            if chunk:
+                yield chunk
+    yield encode(buffer.getvalue(), final=True)
+
+@app.route('/api/export/<kind>.csv', methods=['GET'])
+def export_csv(kind):
+    """流式导出订单、订单项或支出数据为CSV"""
+    if kind not in EXPORTS:
+        return jsonify({'error': '导出类型无效'}), 404
+    
+    start_date_str = request.args.get('startDate', '')
+    end_date_str = request.args.get('endDate', '')
+    compress = request.args.get('gzip', '').lower() in ('1', 'true')
+    
+    try:
+        if start_date_str:
+            start_date = datetime.fromisoformat(start_date_str.split('T')[0])
+        else:
+            # 默认为当年1月1日
+            start_date = datetime(datetime.now().year, 1, 1)
+        
+        if end_date_str:
+            end_date = datetime.fromisoformat(end_date_str.split('T')[0])
+        else:
+            # 默认为今天
+            end_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    except ValueError:
+        return jsonify({'error': '日期格式无效'}), 400
+    
+    # 大范围导出可以提交为后台任务，完成后通过任务接口下载
+    if request.args.get('async', '').lower() in ('1', 'true'):
+        job = enqueue_job('export', {
+            'kind': kind,
+            'startDate': start_date.isoformat(),
+            'endDate': (end_date + timedelta(days=1)).isoformat(),
+            'gzip': compress
+        })
+        return jsonify({'message': '导出任务已提交', 'jobId': job.id, 'status': job.status}), 202
+    
+    # 结束日期当天包含在内
+    header, rows = EXPORTS[kind](start_date, end_date + timedelta(days=1))
+    filename = f"{kind}-{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}.csv"
+    # 压缩时作为.csv.gz文件下载，不设置Content-Encoding，否则浏览器会自动解压后仍以.gz保存
+    headers = {'Content-Disposition': f'attachment; filename={filename}{".gz" if compress else ""}'}
+    
+    return Response(stream_with_context(iter_csv(header, rows, compress)),
+                    mimetype='application/gzip' if compress else 'text/csv', headers=headers)
+
+# 辅助函数，根据预设生成对比期：wow为本周与上周，mom为本月与上月，yoy为本月与去年同月
+def preset_periods(preset, anchor_date):
+    if preset == 'wow':
+        week_start = anchor_date - timedelta(days=anchor_date.weekday())
+        return [(week_start, week_start + timedelta(days=6)),
+                (week_start - timedelta(days=7), week_start - timedelta(days=1))]
+    
+    month_start = anchor_date.replace(day=1)
+    month_end = (month_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    if preset == 'mom':
+        prev_end = month_start - timedelta(days=1)
+        return [(month_start, month_end), (prev_end.replace(day=1), prev_end)]
+    if preset == 'yoy':
+        last_year_start = month_start.replace(year=month_start.year - 1)
+        last_year_end = (last_year_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        return [(month_start, month_end), (last_year_start, last_year_end)]
+    return None
+
+@app.route('/api/finance/compare', methods=['GET'])
+def get_period_comparison():
+    """对比任意多个时间段的收入、支出和利润
+
+    period参数可重复，格式为 开始日期,结束日期（含结束日期当天）；也可以用preset=wow/mom/yoy配合date参数。
+    每个时间段的增长率相对于列表中的下一个时间段计算。
+    """
+    preset = request.args.get('preset', '')
+    try:
+        if preset:
+            date_str = request.args.get('date', '')
+            anchor_date = datetime.fromisoformat(date_str.split('T')[0]) if date_str else \
+                datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            periods = preset_periods(preset, anchor_date)
+            if periods is None:
+                return jsonify({'error': '预设对比方式无效'}), 400
+        else:
+            periods = []
+            for value in request.args.getlist('period'):
+                start_str, end_str = value.split(',')
+                periods.append((datetime.fromisoformat(start_str.strip().split('T')[0]),
+                                datetime.fromisoformat(end_str.strip().split('T')[0])))
+    except ValueError:
+        return jsonify({'error': '日期格式无效'}), 400
+    
+    if not periods or len(periods) > 24:
+        return jsonify({'error': '请提供1到24个对比时间段'}), 400
+    
+    # 结束日期当天包含在内，统一转换为左闭右开区间
+    ranges = [(start, end + timedelta(days=1)) for start, end in periods]
+    
+    def in_periods(column):
+        return db.or_(*[db.and_(column >= start, column < end) for start, end in ranges])
+    
+    # 收入和支出合并为一个明细集合，只取落在任一时间段内的行
+    sources = [
+        db.select(Order.order_date.label('date'), Order.total_amount.label('income'), db.literal(0.0).label('expense'))
+        .where(Order.status == 'completed', in_periods(Order.order_date)),
+        db.select(Expense.expense_date.label('date'), db.literal(0.0).label('income'), Expense.amount.label('expense'))
+        .where(in_periods(Expense.expense_date))
+    ]
+    if range_reaches_archive(min(start for start, _ in ranges)):
+        sources.append(
+            db.select(OrderArchive.order_date.label('date'), OrderArchive.total_amount.label('income'), db.literal(0.0).label('expense'))
+            .where(OrderArchive.status == 'completed', in_periods(OrderArchive.order_date))
+        )
+    entries = db.union_all(*sources).subquery()
+    
+    # 一条条件聚合查询同时算出所有时间段的收入和支出
+    columns = []
+    for start, end in ranges:
+        in_range = db.and_(entries.c.date >= start, entries.c.date < end)
+        columns.append(db.func.coalesce(db.func.sum(db.case((in_range, entries.c.income), else_=0)), 0))
+        columns.append(db.func.coalesce(db.func.sum(db.case((in_range, entries.c.expense), else_=0)), 0))
+    totals = db.session.execute(db.select(*columns)).one()
+    
+    result = []
+    for i, (start, end) in enumerate(periods):
+        income, expense = totals[2 * i], totals[2 * i + 1]
+        result.append({
+            'startDate': start.date().isoformat(),
+            'endDate': end.date().isoformat(),
+            'income': round(income, 2),
+            'expense': round(expense, 2),
+            'profit': round(income - expense, 2)
+        })
+    
+    # 与下一个时间段比较计算增长率，口径与月度概览一致
+    for current, previous in zip(result, result[1:]):
+        current['incomeTrend'] = round((current['income'] - previous['income']) / previous['income'] * 100, 1) if previous['income'] > 0 else 0
+        current['expenseTrend'] = round((current['expense'] - previous['expense']) / previous['expense'] * 100, 1) if previous['expense'] > 0 else 0
+        current['profitTrend'] = round((current['profit'] - previous['profit']) / previous['profit'] * 100, 1) if previous['profit'] > 0 else 0
+    
+    return jsonify(result)
+
 # 辅助函数，获取面包类型的中文名称
 def get_bread_type_name(bread_type):
     bread_type_names = {
@@ -1090,9 +3243,56 @@ def get_bread_type_name(bread_type):
     return bread_type_names.get(bread_type, bread_type)
 
 # 支出管理相关接口
+def expense_to_dict(expense):
+    return {
+        'id': expense.id,
+        'expenseDate': expense.expense_date.isoformat(),
+        'category': expense.category,
+        'amount': expense.amount,
+        'note': expense.note,
+        'createdBy': expense.created_by,
+        'createdAt': expense.created_at.isoformat()
+    }
+
+# 辅助函数，按支出记录重新计算类别表，用于回填和批量生成支出之后
+def rebuild_expense_categories():
+    counts = dict(db.session.query(Expense.category, db.func.count(Expense.id)).group_by(Expense.category).all())
+    for category in ExpenseCategory.query.all():
+        category.expense_count = counts.pop(category.name, 0)
+    db.session.add_all(ExpenseCategory(name=name, expense_count=count) for name, count in counts.items())
+    db.session.commit()
+    invalidate_expense_categories()
+
+@app.cli.command('rebuild-expense-categories')
+def rebuild_expense_categories_command():
+    """根据现有支出记录重建支出类别表"""
+    for_each_store(rebuild_expense_categories)
+    print('支出类别表已重建')
+
+# 辅助函数，在当前事务中调整类别的记录数，类别不存在时创建
+def adjust_expense_category(name, delta):
+    updated = ExpenseCategory.query.filter_by(name=name).update(
+        {'expense_count': ExpenseCategory.expense_count + delta}, synchronize_session=False)
+    if updated or delta <= 0:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(ExpenseCategory(name=name, expense_count=delta))
+    except IntegrityError:
+        # 并发请求已创建该类别
+        ExpenseCategory.query.filter_by(name=name).update(
+            {'expense_count': ExpenseCategory.expense_count + delta}, synchronize_session=False)
+
+# 支出类别的进程内缓存：{门店ID: (过期时间, 类别列表)}，本进程写入支出后立即失效，
+# 其他worker的写入最多延迟EXPENSE_CATEGORY_CACHE_SECONDS秒可见
+_expense_category_cache = {}
+
+def invalidate_expense_categories():
+    _expense_category_cache.pop(store_id_or_default(), None)
+
 @app.route('/api/expenses', methods=['GET'])
 def get_expenses():
-    """获取所有支出记录"""
+    """获取支出记录：传入limit或cursor时按游标分页并返回各类别合计，否则流式返回全部记录"""
     # 获取查询参数
     start_date_str = request.args.get('startDate', '')
     end_date_str = request.args.get('endDate', '')
@@ -1107,12 +3307,10 @@ def get_expenses():
         if start_date_str:
             start_date = datetime.fromisoformat(start_date_str)
             query = query.filter(Expense.expense_date >= start_date)
-            print(f"开始日期: {start_date}")
         
         if end_date_str:
             end_date = datetime.fromisoformat(end_date_str)
             query = query.filter(Expense.expense_date <= end_date)
-            print(f"结束日期: {end_date}")
     except ValueError as e:
         print(f"日期格式错误: {e}")
         return jsonify({'error': '日期格式无效'}), 400
@@ -1120,30 +3318,63 @@ def get_expenses():
     # 按类别筛选
     if category:
         query = query.filter(Expense.category == category)
-        print(f"筛选类别: {category}")
-    
-    # 按日期倒序排序
-    expenses = query.order_by(Expense.expense_date.desc()).all()
-    print(f"查询到 {len(expenses)} 条支出记录")
     
-    # 打印第一条记录（如果有的话）
-    if expenses:
-        print(f"第一条记录: {expenses[0].id}, {expenses[0].expense_date}, {expenses[0].amount}")
+    # 按日期倒序排序，ID作为同一时间的次序，保证游标位置唯一
+    query = query.order_by(Expense.expense_date.desc(), Expense.id.desc())
+    
+    # 未传分页参数时保持原有返回格式，分批读取并逐条输出，不在内存中构建完整列表
+    if 'limit' not in request.args and 'cursor' not in request.args:
+        def generate():
+            yield '['
+            for i, expense in enumerate(query.yield_per(500)):
+                yield (',' if i else '') + json.dumps(expense_to_dict(expense), ensure_ascii=False)
+            yield ']'
+        return Response(stream_with_context(generate()), mimetype='application/json')
+    
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    cursor = request.args.get('cursor', '')
+    page_query = query
+    if cursor:
+        # 游标为上一页最后一条记录的 支出日期_ID，从其之后继续读取，不受翻页深度影响
+        try:
+            cursor_date_str, cursor_id_str = cursor.rsplit('_', 1)
+            cursor_date = datetime.fromisoformat(cursor_date_str)
+            cursor_id = int(cursor_id_str)
+        except ValueError:
+            return jsonify({'error': '游标格式无效'}), 400
+        page_query = query.filter(db.or_(
+            Expense.expense_date < cursor_date,
+            db.and_(Expense.expense_date == cursor_date, Expense.id < cursor_id)
+        ))
+    
+    # 多取一条判断是否还有下一页
+    expenses = page_query.limit(limit + 1).all()
+    has_more = len(expenses) > limit
+    expenses = expenses[:limit]
+    result = {
+        'items': [expense_to_dict(expense) for expense in expenses],
+        'nextCursor': f"{expenses[-1].expense_date.isoformat()}_{expenses[-1].id}" if has_more else None
+    }
     
-    result = [{
-        'id': expense.id,
-        'expenseDate': expense.expense_date.isoformat(),
-        'category': expense.category,
-        'amount': expense.amount,
-        'note': expense.note,
-        'createdBy': expense.created_by,
-        'createdAt': expense.created_at.isoformat()
-    } for expense in expenses]
+    # 各类别合计按整个筛选范围计算，只在第一页返回
+    if not cursor:
+        rows = query.order_by(None).with_entities(
+            Expense.category,
+            db.func.count(Expense.id),
+            db.func.sum(Expense.amount)
+        ).group_by(Expense.category).all()
+        result['categoryTotals'] = sorted([{
+            'category': category_name,
+            'count': count,
+            'amount': round(amount or 0, 2)
+        } for category_name, count, amount in rows], key=lambda x: x['amount'], reverse=True)
+        result['total'] = sum(count for _, count, _ in rows)
+        result['totalAmount'] = round(sum(amount or 0 for _, _, amount in rows), 2)
     
-    print(f"返回 {len(result)} 条记录")
     return jsonify(result)
 
 @app.route('/api/expenses', methods=['POST'])
+@idempotent('expenses')
 def create_expense():
     """创建新的支出记录"""
     data = request.json
@@ -1162,7 +3393,9 @@ def create_expense():
     )
     
     db.session.add(expense)
+    adjust_expense_category(expense.category, 1)
     db.session.commit()
+    invalidate_expense_categories()
     
     return jsonify({
         'message': '支出记录创建成功',
@@ -1181,7 +3414,9 @@ def update_expense(expense_id):
         except ValueError:
             return jsonify({'error': '日期格式无效'}), 400
     
-    if 'category' in data:
+    if 'category' in data and data['category'] != expense.category:
+        adjust_expense_category(expense.category, -1)
+        adjust_expense_category(data['category'], 1)
         expense.category = data['category']
     
     if 'amount' in data:
@@ -1191,6 +3426,7 @@ def update_expense(expense_id):
         expense.note = data['note']
     
     db.session.commit()
+    invalidate_expense_categories()
     
     return jsonify({'message': '支出记录更新成功'})
 
@@ -1198,26 +3434,390 @@ def update_expense(expense_id):
 def delete_expense(expense_id):
     """删除支出记录"""
     expense = Expense.query.get_or_404(expense_id)
+    adjust_expense_category(expense.category, -1)
     db.session.delete(expense)
     db.session.commit()
+    invalidate_expense_categories()
     
     return jsonify({'message': '支出记录删除成功'})
 
 @app.route('/api/expenses/categories', methods=['GET'])
 def get_expense_categories():
-    """获取所有支出类别"""
-    # 从数据库中获取所有不同的支出类别
-    categories = db.session.query(Expense.category).distinct().all()
-    
-    # 提取类别名称
-    category_names = [category[0] for category in categories]
-    
-    # 如果数据库中没有类别，返回默认类别
+    """获取所有支出类别，读取类别表并在进程内缓存"""
+    store_id = store_id_or_default()
+    cached = _expense_category_cache.get(store_id)
+    if cached is None or cached[0] < time.time():
+        names = [name for (name,) in db.session.query(ExpenseCategory.name)
+                 .filter(ExpenseCategory.expense_count > 0).order_by(ExpenseCategory.name)]
+        cached = _expense_category_cache[store_id] = (time.time() + app.config.get('EXPENSE_CATEGORY_CACHE_SECONDS', 60), names)
+    category_names = cached[1]
+    
+    # 如果还没有支出类别，返回默认类别
     if not category_names:
         category_names = ['原料采购', '人工成本', '水电费用', '设备维护', '店铺租金', '其他支出']
     
     return jsonify(category_names)
 
+# 后台任务：Web请求只负责写入任务记录，由独立的任务进程（flask --app app run-jobs）领取执行
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return register
+
+@job_handler('export')
+def run_export_job(job):
+    params = job.params or {}
+    start_date = datetime.fromisoformat(params['startDate'])
+    end_date = datetime.fromisoformat(params['endDate'])
+    compress = params.get('gzip', False)
+    header, rows = EXPORTS[params['kind']](start_date, end_date)
+    
+    result_dir = app.config.get('JOB_RESULT_DIR', 'job_results')
+    os.makedirs(result_dir, exist_ok=True)
+    path = os.path.join(result_dir, f"{job.id}-{params['kind']}.csv{'.gz' if compress else ''}")
+    with open(path, 'wb') as f:
+        for chunk in iter_csv(header, rows, compress):
+            f.write(chunk)
+    return {'size': os.path.getsize(path)}, path
+
+@job_handler('archive-orders')
+def run_archive_job(job):
+    params = job.params or {}
+    return {'archived': archive_orders(params.get('days'), params.get('batchSize'))}, None
+
+@job_handler('update-forecast')
+def run_forecast_job(job):
+    bread_ids, state = refresh_sales_forecast()
+    return {'breads': len(bread_ids), 'observedDays': state['observed_days']}, None
+
+@job_handler('backfill-customers')
+def run_backfill_customers_job(job):
+    backfill_customers()
+    return {'customers': Customer.query.count()}, None
+
+@job_handler('backfill-order-summary')
+def run_backfill_order_summary_job(job):
+    backfill_order_summary(Order, OrderItem)
+    backfill_order_summary(OrderArchive, OrderItemArchive)
+    return {}, None
+
+# 任何人都可以提交的任务类型；归档、回填、预测重算等维护任务只允许管理员提交
+PUBLIC_JOB_KINDS = {'export'}
+
+def enqueue_job(kind, params=None):
+    job = Job(kind=kind, params=params or {})
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def job_to_dict(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'params': job.params,
+        'status': job.status,
+        'result': job.result,
+        'hasFile': bool(job.result_path),
+        'error': job.error,
+        'attempts': job.attempts,
+        'createdAt': job.created_at.isoformat() if job.created_at else None,
+        'startedAt': job.started_at.isoformat() if job.started_at else None,
+        'finishedAt': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+# 任务执行器：线程池大小即任务并发上限，与Web worker数量无关
+class JobRunner:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='job')
+        self.running = set()
+        self.lock = threading.Lock()
+
+    def requeue_stale_jobs(self):
+        """心跳超时的任务视为执行进程已退出：未超过重试次数的重新排队，否则标记失败"""
+        stale_before = datetime.utcnow() - timedelta(seconds=app.config.get('JOB_STALE_SECONDS', 120))
+        stale = Job.query.filter(Job.status == 'running', Job.heartbeat_at < stale_before)
+        max_attempts = app.config.get('JOB_MAX_ATTEMPTS', 3)
+        stale.filter(Job.attempts < max_attempts).update(
+            {'status': 'queued', 'worker': None}, synchronize_session=False)
+        stale.filter(Job.attempts >= max_attempts).update(
+            {'status': 'failed', 'error': '任务执行进程中断', 'finished_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+
+    def claim(self, limit):
+        """按创建顺序领取排队中的任务，通过带状态条件的UPDATE保证同一任务只被一个进程领取"""
+        claimed = []
+        candidates = [job_id for (job_id,) in db.session.query(Job.id).filter(Job.status == 'queued')
+                      .order_by(Job.created_at).limit(limit * 2)]
+        for job_id in candidates:
+            now = datetime.utcnow()
+            updated = Job.query.filter(Job.id == job_id, Job.status == 'queued').update({
+                'status': 'running',
+                'worker': self.name,
+                'attempts': Job.attempts + 1,
+                'started_at': now,
+                'heartbeat_at': now
+            }, synchronize_session=False)
+            db.session.commit()
+            if updated:
+                claimed.append(job_id)
+            if len(claimed) >= limit:
+                break
+        return claimed
+
+    def heartbeat(self):
+        with self.lock:
+            running = list(self.running)
+        if running:
+            Job.query.filter(Job.id.in_(running), Job.worker == self.name).update(
+                {'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+
+    def execute(self, job_id):
+        with app.app_context():
+            job = db.session.get(Job, job_id)
+            g.store_id = job.store_id  # 任务在提交它的门店下执行
+            try:
+                result, path = JOB_HANDLERS[job.kind](job)
+                job.status = 'succeeded'
+                job.result = result
+                job.result_path = path
+            except Exception as e:
+                db.session.rollback()
+                job = db.session.get(Job, job_id)
+                job.status = 'failed'
+                job.error = str(e)
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            db.session.remove()
+        with self.lock:
+            self.running.discard(job_id)
+
+    def run_forever(self):
+        poll_interval = app.config.get('JOB_POLL_INTERVAL', 1.0)
+        last_heartbeat = 0
+        print(f'任务执行器已启动：{self.name}，并发上限 {self.concurrency}')
+        with app.app_context():
+            self.requeue_stale_jobs()
+            while True:
+                try:
+                    with self.lock:
+                        free_slots = self.concurrency - len(self.running)
+                    if free_slots > 0:
+                        for job_id in self.claim(free_slots):
+                            with self.lock:
+                                self.running.add(job_id)
+                            self.executor.submit(self.execute, job_id)
+                    if time.time() - last_heartbeat > 10:
+                        self.heartbeat()
+                        self.requeue_stale_jobs()
+                        last_heartbeat = time.time()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"任务调度失败: {e}")
+                finally:
+                    db.session.remove()
+                time.sleep(poll_interval)
+
+@app.cli.command('run-jobs')
+@click.option('--concurrency', type=int, default=None, help='同时执行的任务数，默认读取JOB_CONCURRENCY')
+def run_jobs_command(concurrency):
+    """启动后台任务执行进程"""
+    JobRunner(concurrency or app.config.get('JOB_CONCURRENCY', 2)).run_forever()
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """提交后台任务"""
+    data = request.json
+    if data.get('kind') not in JOB_HANDLERS:
+        return jsonify({'error': '任务类型无效'}), 400
+    if data['kind'] not in PUBLIC_JOB_KINDS:
+        denied = require_admin()
+        if denied:
+            return denied
+    job = enqueue_job(data['kind'], data.get('params'))
+    return jsonify({'message': '任务已提交', 'jobId': job.id, 'status': job.status}), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = Job.query.get_or_404(job_id)
+    return jsonify(job_to_dict(job))
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def download_job_result(job_id):
+    """下载任务生成的结果文件"""
+    job = Job.query.get_or_404(job_id)
+    if job.status != 'succeeded':
+        return jsonify({'message': '任务尚未完成', 'status': job.status}), 409
+    if not job.result_path or not os.path.exists(job.result_path):
+        return jsonify({'message': '该任务没有结果文件'}), 404
+    # .csv.gz按扩展名会被识别为text/csv，显式指定为gzip文件
+    return send_file(os.path.abspath(job.result_path), as_attachment=True,
+                     download_name=os.path.basename(job.result_path),
+                     mimetype='application/gzip' if job.result_path.endswith('.gz') else None)
+
+# 按需性能分析：管理员带令牌请求或按采样率触发，用cProfile记录请求并统计SQL耗时
+def profiling_authorized():
+    token = app.config.get('PROFILING_TOKEN')
+    # 定长比较，避免按响应时间逐字符猜出令牌
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Profile-Token', '').encode(), token.encode())
+
+# Python 3.12起cProfile基于进程级的sys.monitoring，同一进程同时只能启用一个分析器（再次启用会抛出ValueError），
+# 且会记录到其他线程的调用；gthread worker中同一时间只分析一个请求，已有请求在分析时跳过
+_profiling_lock = threading.Lock()
+
+@app.before_request
+def start_profiling():
+    requested = request.headers.get('X-Profile') == '1' or request.args.get('_profile') == '1'
+    if not (requested and profiling_authorized()) and random.random() >= app.config.get('PROFILE_SAMPLE_RATE', 0.0):
+        return
+    if not _profiling_lock.acquire(blocking=False):
+        return
+    g.sql_log = []
+    g.profile_started = time.perf_counter()
+    g.profiler = cProfile.Profile()
+    try:
+        g.profiler.enable()
+    except ValueError:
+        # 其他分析工具（如调试器、coverage）已占用
+        g.pop('profiler')
+        g.pop('sql_log')
+        _profiling_lock.release()
+
+# 请求异常时不会执行after_request，在请求结束时确保停止分析并释放锁
+@app.teardown_request
+def stop_profiling(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profiling_lock.release()
+
+@app.after_request
+def finish_profiling(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    _profiling_lock.release()
+    duration = time.perf_counter() - g.profile_started
+    sql_log = g.pop('sql_log', [])
+    
+    try:
+        profile_dir = app.config.get('PROFILE_DIR', 'profiles')
+        os.makedirs(profile_dir, exist_ok=True)
+        name = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}-{os.getpid()}-{request.method}" \
+               f"-{re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_')}"
+        profiler.dump_stats(os.path.join(profile_dir, f'{name}.prof'))
+        
+        # 同时保存摘要，列表接口只读取摘要文件
+        stats = pstats.Stats(profiler).stats
+        top_functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:15]
+        summary = {
+            'id': name,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'durationMs': round(duration * 1000, 2),
+            'sqlCount': len(sql_log),
+            'sqlMs': round(sum(elapsed for _, elapsed in sql_log) * 1000, 2),
+            'slowestSql': [{'statement': statement[:500], 'ms': round(elapsed * 1000, 2)}
+                           for statement, elapsed in sorted(sql_log, key=lambda x: x[1], reverse=True)[:5]],
+            'topFunctions': [{'function': f'{filename}:{line}({function})', 'calls': stats_row[1],
+                              'cumulativeMs': round(stats_row[3] * 1000, 2)}
+                             for (filename, line, function), stats_row in top_functions],
+            'createdAt': datetime.utcnow().isoformat()
+        }
+        with open(os.path.join(profile_dir, f'{name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+        
+        # 只保留最近的若干份分析结果
+        summaries = sorted(entry for entry in os.listdir(profile_dir) if entry.endswith('.json'))
+        for entry in summaries[:-app.config.get('PROFILE_KEEP', 200)]:
+            for suffix in ('.json', '.prof'):
+                path = os.path.join(profile_dir, entry[:-5] + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+    except OSError as e:
+        print(f"保存性能分析结果失败: {e}")
+    
+    return response
+
+# SQL耗时统计，只在被分析的请求中记录
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('sql_log') is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('sql_log') is not None and conn.info.get('query_started'):
+        g.sql_log.append((statement, time.perf_counter() - conn.info['query_started'].pop()))
+
+with app.app_context():
+    for engine in db.engines.values():
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+@app.route('/api/admin/profiles', methods=['GET'])
+def get_profiles():
+    """列出最近被分析的请求，按耗时降序"""
+    if not profiling_authorized():
+        return jsonify({'message': '无权访问'}), 403
+    
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+    profile_dir = app.config.get('PROFILE_DIR', 'profiles')
+    summaries = []
+    if os.path.isdir(profile_dir):
+        for entry in os.listdir(profile_dir):
+            if not entry.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(profile_dir, entry), encoding='utf-8') as f:
+                    summaries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    summaries.sort(key=lambda summary: summary['durationMs'], reverse=True)
+    return jsonify(summaries[:limit])
+
+# 回填订单修改时间：新增updated_at列之前的订单以下单时间作为修改时间
+def backfill_order_updated_at():
+    Order.query.filter(Order.updated_at.is_(None)).update({'updated_at': Order.order_date}, synchronize_session=False)
+    db.session.commit()
+
+@app.cli.command('upgrade-db')
+@click.option('--backfill/--no-backfill', default=True, help='升级后回填新增列的数据')
+def upgrade_db_command(backfill):
+    """升级已有数据库：补充新增的列、索引和约束，然后依次回填新增列，升级代码后部署前执行"""
+    for bind_key, engine in db.engines.items():
+        changes = upgrade_schema(engine)
+        print(f"{bind_key or '默认库'}：{len(changes)}项变更")
+        for change in changes:
+            print(f'  {change}')
+    ensure_stores()
+    for bind_key, count in sync_store_categories().items():
+        print(f'{bind_key}：补充{count}个面包分类')
+    if not backfill:
+        return
+    
+    # 回填依赖上面新增的列，顺序不能调换：客户汇总依赖订单金额，面包销量依赖bread_id
+    for_each_store(backfill_order_updated_at)
+    for_each_store(backfill_order_summary, Order, OrderItem)
+    for_each_store(backfill_order_summary, OrderArchive, OrderItemArchive)
+    for_each_store(backfill_order_item_bread, OrderItem)
+    for_each_store(backfill_order_item_bread, OrderItemArchive)
+    for_each_store(backfill_customers)
+    for_each_store(rebuild_expense_categories)
+    print('数据回填完成')
+
+@app.cli.command('init-db')
+def init_db_command():
+    """创建数据表并写入示例数据，部署或首次运行前执行一次"""
+    init_db()
+    print('数据库初始化完成')
+
 if __name__ == '__main__':
-    init_db()  # 初始化数据库
+    # 首次运行前先执行 flask --app app init-db 初始化数据库
+    warm_best_seller_boards()
     app.run(debug=True, port=5050)
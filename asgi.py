@@ -0,0 +1,224 @@
+"""异步服务入口：uvicorn asgi:app --workers 4
+
+财务接口在这里用异步SQLAlchemy重写，同一请求内互不依赖的查询并发执行；
+其余接口转发给原有的Flask应用，在线程池中运行。门店的确定方式与Flask应用一致
+（X-Store-Id请求头或store参数），使用独立数据库的门店查询各自的库。
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import config
+
+# uvicorn多worker不预加载应用，未设置时每个worker各自随机生成密钥，签发的登录令牌在其他worker上验证失败
+if not config.SECRET_KEY:
+    raise RuntimeError('异步服务必须通过SECRET_KEY环境变量设置登录令牌签名密钥')
+
+from app import app as flask_app, Order, OrderArchive, Expense
+
+# 同步驱动换成对应的异步驱动
+ASYNC_DRIVERS = {
+    'mysql+pymysql': 'mysql+aiomysql',
+    'mysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+
+def async_database_uri(uri):
+    scheme, rest = uri.split('://', 1)
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+
+def create_engine(uri):
+    return create_async_engine(
+        uri,
+        pool_recycle=config.SQLALCHEMY_POOL_RECYCLE,
+        **({'pool_size': config.SQLALCHEMY_POOL_SIZE} if not uri.startswith('sqlite') else {})
+    )
+
+
+# None对应默认库，其余为使用独立数据库的门店
+engines = {None: create_engine(config.ASYNC_DATABASE_URI or async_database_uri(flask_app.config['SQLALCHEMY_DATABASE_URI']))}
+for store_id, uri in config.STORE_DATABASES.items():
+    engines[store_id] = create_engine(async_database_uri(uri))
+sessions = {key: async_sessionmaker(engine, expire_on_commit=False) for key, engine in engines.items()}
+
+
+def store_session(store_id):
+    return sessions.get(store_id, sessions[None])()
+
+
+def request_store_id(request):
+    """与Flask应用相同的门店确定方式，门店ID无效时抛出ValueError"""
+    value = request.headers.get('x-store-id') or request.query_params.get('store')
+    return int(value) if value else config.DEFAULT_STORE_ID
+
+
+async def scalar(store_id, statement):
+    """在独立会话中执行一条查询，便于用asyncio.gather并发执行多条查询"""
+    async with store_session(store_id) as session:
+        return await session.scalar(statement)
+
+
+def month_range(year, month):
+    """与同步接口相同的月份起止时间"""
+    start_date = datetime(year, month, 1)
+    if month == 12:
+        end_date = datetime(year + 1, 1, 1) - timedelta(days=1)
+    else:
+        end_date = datetime(year, month + 1, 1) - timedelta(days=1)
+    return start_date, end_date
+
+
+async def income_between(store_id, start_date, end_date):
+    """已完成订单收入，热表和归档表并发求和"""
+    totals = await asyncio.gather(*[
+        scalar(store_id, select(func.coalesce(func.sum(order_model.total_amount), 0)).where(
+            order_model.store_id == store_id,
+            order_model.order_date >= start_date,
+            order_model.order_date <= end_date,
+            order_model.status == 'completed'
+        )) for order_model in (Order, OrderArchive)
+    ])
+    return sum(totals)
+
+
+async def expense_between(store_id, start_date, end_date):
+    return await scalar(store_id, select(func.coalesce(func.sum(Expense.amount), 0)).where(
+        Expense.store_id == store_id,
+        Expense.expense_date >= start_date,
+        Expense.expense_date <= end_date
+    ))
+
+
+def trend(current, previous):
+    return ((current - previous) / previous * 100) if previous > 0 else 0
+
+
+async def monthly_summary(request):
+    """获取当前月的财务概览数据，本月和上月的收入、支出同时查询"""
+    try:
+        store_id = request_store_id(request)
+    except ValueError:
+        return JSONResponse({'error': '门店ID无效'}, status_code=400)
+    try:
+        year = int(request.query_params.get('year', datetime.now().year))
+        month = int(request.query_params.get('month', datetime.now().month))
+    except ValueError:
+        year, month = datetime.now().year, datetime.now().month
+
+    start_date, end_date = month_range(year, month)
+    prev_month_start, prev_month_end = month_range(year - 1, 12) if month == 1 else month_range(year, month - 1)
+
+    current_income, prev_income, current_expense, prev_expense = await asyncio.gather(
+        income_between(store_id, start_date, end_date),
+        income_between(store_id, prev_month_start, prev_month_end),
+        expense_between(store_id, start_date, end_date),
+        expense_between(store_id, prev_month_start, prev_month_end)
+    )
+
+    current_profit = current_income - current_expense
+    prev_profit = prev_income - prev_expense
+
+    return JSONResponse({
+        'monthlyIncome': round(current_income, 2),
+        'monthlyExpense': round(current_expense, 2),
+        'monthlyProfit': round(current_profit, 2),
+        'incomeTrend': round(trend(current_income, prev_income), 1),
+        'expenseTrend': round(trend(current_expense, prev_expense), 1),
+        'profitTrend': round(trend(current_profit, prev_profit), 1)
+    })
+
+
+async def finance_trends(request):
+    """获取近6个月的财务趋势数据，12条汇总查询并发执行"""
+    try:
+        store_id = request_store_id(request)
+    except ValueError:
+        return JSONResponse({'error': '门店ID无效'}, status_code=400)
+    today = datetime.now()
+    months = []
+    for i in range(5, -1, -1):
+        target_month = today.month - i
+        target_year = today.year
+        while target_month <= 0:
+            target_month += 12
+            target_year -= 1
+        months.append((target_year, target_month))
+
+    ranges = [month_range(year, month) for year, month in months]
+    results = await asyncio.gather(
+        *[income_between(store_id, start, end) for start, end in ranges],
+        *[expense_between(store_id, start, end) for start, end in ranges]
+    )
+    incomes, expenses = results[:len(ranges)], results[len(ranges):]
+
+    return JSONResponse({
+        'labels': [f"{month}月" for _, month in months],
+        'income': [round(income, 2) for income in incomes],
+        'expense': [round(expense, 2) for expense in expenses],
+        'profit': [round(income - expense, 2) for income, expense in zip(incomes, expenses)]
+    })
+
+
+async def expense_composition(request):
+    """获取支出构成数据，在数据库中按类别汇总"""
+    start_date_str = request.query_params.get('startDate', '')
+    end_date_str = request.query_params.get('endDate', '')
+    try:
+        store_id = request_store_id(request)
+    except ValueError:
+        return JSONResponse({'error': '门店ID无效'}, status_code=400)
+    try:
+        start_date = datetime.fromisoformat(start_date_str.split('T')[0]) if start_date_str else datetime(datetime.now().year, 1, 1)
+        end_date = datetime.fromisoformat(end_date_str.split('T')[0]) if end_date_str else datetime.now()
+    except ValueError:
+        return JSONResponse({'error': '日期格式无效'}, status_code=400)
+
+    async with store_session(store_id) as session:
+        rows = (await session.execute(
+            select(Expense.category, func.sum(Expense.amount)).where(
+                Expense.store_id == store_id,
+                Expense.expense_date >= start_date,
+                Expense.expense_date <= end_date
+            ).group_by(Expense.category)
+        )).all()
+
+    total_expense = sum(amount for _, amount in rows)
+    result = [{
+        'name': category,
+        'value': round(amount, 2),
+        'percentage': round((amount / total_expense * 100) if total_expense > 0 else 0, 1)
+    } for category, amount in rows]
+    result.sort(key=lambda x: x['value'], reverse=True)
+
+    if not result:
+        result = [{'name': '暂无支出', 'value': 0, 'percentage': 0}]
+
+    return JSONResponse(result)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    for engine in engines.values():
+        await engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/finance/monthly-summary', monthly_summary),
+        Route('/api/finance/trends', finance_trends),
+        Route('/api/finance/expense-composition', expense_composition),
+        # 其余接口仍由Flask处理
+        Mount('/', WSGIMiddleware(flask_app))
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,68 @@
+"""销量预测：按星期季节性的指数平滑模型，所有面包同时向量化计算"""
+import numpy as np
+
+
+def initial_state(product_count):
+    """创建空的模型状态：level为每个面包的基础日销量，seasonal为7×面包的星期偏移"""
+    return {
+        'level': np.zeros(product_count),
+        'seasonal': np.zeros((7, product_count)),
+        'observed_days': 0
+    }
+
+
+def extend_state(state, product_count):
+    """新增面包时在状态末尾补零列"""
+    extra = product_count - state['level'].shape[0]
+    if extra <= 0:
+        return state
+    return {
+        'level': np.concatenate([state['level'], np.zeros(extra)]),
+        'seasonal': np.concatenate([state['seasonal'], np.zeros((7, extra))], axis=1),
+        'observed_days': state['observed_days']
+    }
+
+
+def update(state, sales, first_weekday, alpha=0.3, gamma=0.2):
+    """用 天×面包 的销量矩阵逐日更新模型状态
+
+    sales的第0行对应星期first_weekday（0为周一）。每一步对所有面包同时计算，
+    因此耗时只与天数成正比，与面包数量基本无关。
+    """
+    level = state['level'].copy()
+    seasonal = state['seasonal'].copy()
+    observed_days = state['observed_days']
+
+    for t, actual in enumerate(sales):
+        weekday = (first_weekday + t) % 7
+        if observed_days == 0:
+            # 第一天直接以实际销量作为基础水平
+            level = actual.astype(float)
+        else:
+            new_level = alpha * (actual - seasonal[weekday]) + (1 - alpha) * level
+            seasonal[weekday] = gamma * (actual - new_level) + (1 - gamma) * seasonal[weekday]
+            level = new_level
+        observed_days += 1
+
+    return {'level': level, 'seasonal': seasonal, 'observed_days': observed_days}
+
+
+def predict(state, weekday):
+    """预测指定星期几的销量，结果不小于0"""
+    return np.maximum(state['level'] + state['seasonal'][weekday], 0)
+
+
+def state_to_json(state):
+    return {
+        'level': state['level'].tolist(),
+        'seasonal': state['seasonal'].tolist(),
+        'observed_days': state['observed_days']
+    }
+
+
+def state_from_json(data):
+    return {
+        'level': np.array(data['level'], dtype=float),
+        'seasonal': np.array(data['seasonal'], dtype=float).reshape(7, -1),
+        'observed_days': data['observed_days']
+    }
@@ -0,0 +1,64 @@
+"""gunicorn生产配置：gunicorn -c gunicorn.conf.py wsgi:app
+
+主进程预加载应用后fork出worker，代码和只读数据通过写时复制共享；
+fork后丢弃从主进程继承的数据库连接池，每个worker使用自己的连接。
+"""
+import gc
+import multiprocessing
+import os
+import time
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5050')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# SSE长连接会占用一个线程，使用线程型worker避免阻塞其他请求
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+preload_app = True
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+
+def memory_usage_kb():
+    """读取当前进程的RSS和私有内存（KB），私有内存体现写时复制后每个worker的实际开销"""
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    usage[key] = int(value.split()[0])
+    except OSError:
+        import resource
+        usage['Rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage
+
+
+def when_ready(server):
+    usage = memory_usage_kb()
+    server.log.info('主进程已就绪，RSS %s KB', usage.get('Rss'))
+
+
+def pre_fork(server, worker):
+    # 把预加载阶段产生的对象移出GC跟踪，避免worker中的垃圾回收触碰这些页面导致写时复制失效
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    worker.boot_started = time.perf_counter()
+    from app import app, db
+    with app.app_context():
+        # close=False：不关闭主进程仍在使用的连接，只让本worker丢弃继承的连接池
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # 预热放在worker中执行：后台线程和榜单数据都属于各个worker，不能在预加载的主进程中创建
+    from app import warm_best_seller_boards
+    warm_best_seller_boards()
+    boot_ms = (time.perf_counter() - worker.boot_started) * 1000
+    usage = memory_usage_kb()
+    private_kb = usage.get('Private_Clean', 0) + usage.get('Private_Dirty', 0)
+    worker.log.info('worker %s 启动耗时 %.1f ms，RSS %s KB，PSS %s KB，私有内存 %s KB',
+                    worker.pid, boot_ms, usage.get('Rss'), usage.get('Pss'), private_kb)
@@ -0,0 +1,61 @@
+"""面包配方解析：把Bread.ingredients中的用量文本转换为数值矩阵"""
+import re
+
+import numpy as np
+
+# 单位换算到基础单位：重量统一为g，体积统一为ml，计件统一为个
+UNIT_CONVERSIONS = {
+    'g': ('g', 1),
+    '克': ('g', 1),
+    'kg': ('g', 1000),
+    '千克': ('g', 1000),
+    '公斤': ('g', 1000),
+    'mg': ('g', 0.001),
+    'ml': ('ml', 1),
+    '毫升': ('ml', 1),
+    'l': ('ml', 1000),
+    '升': ('ml', 1000),
+    '个': ('个', 1),
+    '颗': ('个', 1),
+    '片': ('片', 1),
+}
+
+QUANTITY_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([^\d\s]*)\s*$')
+
+
+def parse_quantity(text):
+    """解析 '500g'、'0.5kg'、'300ml' 这类用量，返回 (数值, 基础单位)，无法解析时返回None"""
+    if isinstance(text, (int, float)):
+        return float(text), 'g'
+    match = QUANTITY_PATTERN.match(str(text))
+    if not match:
+        return None
+    amount, unit = float(match.group(1)), match.group(2).lower()
+    if not unit:
+        return amount, 'g'
+    base_unit, factor = UNIT_CONVERSIONS.get(unit, (unit, 1))
+    return amount * factor, base_unit
+
+
+def build_recipe_matrix(recipes):
+    """根据 {面包ID: 配方} 构建 面包×原料 的用量矩阵
+
+    返回 (面包ID列表, 原料列表[(名称, 单位)], 矩阵)，矩阵第i行是第i个面包每件的原料用量。
+    """
+    bread_ids = sorted(recipes)
+    ingredient_index = {}
+    entries = []
+    for row, bread_id in enumerate(bread_ids):
+        for name, text in (recipes[bread_id] or {}).items():
+            parsed = parse_quantity(text)
+            if parsed is None:
+                continue
+            amount, unit = parsed
+            column = ingredient_index.setdefault((name, unit), len(ingredient_index))
+            entries.append((row, column, amount))
+
+    matrix = np.zeros((len(bread_ids), len(ingredient_index)))
+    if entries:
+        rows, columns, amounts = zip(*entries)
+        np.add.at(matrix, (np.array(rows), np.array(columns)), np.array(amounts))
+    return bread_ids, list(ingredient_index), matrix
@@ -0,0 +1,17 @@
+"""生产环境WSGI入口：gunicorn -c gunicorn.conf.py wsgi:app
+
+gunicorn以preload方式在主进程中导入本模块，worker fork后直接复用已加载的代码和映射配置。
+数据库初始化不在这里执行，部署时先运行 flask --app app init-db。
+"""
+from sqlalchemy.orm import configure_mappers
+
+import config
+
+# 各worker和重启前后必须使用同一个签名密钥，否则登录令牌会随机失效
+if not config.SECRET_KEY:
+    raise RuntimeError('生产环境必须通过SECRET_KEY环境变量设置登录令牌签名密钥')
+
+from app import app
+
+# 在主进程中完成ORM映射配置，避免每个worker处理首个请求时再做一遍
+configure_mappers()